@@ -1,9 +1,303 @@
 #!/usr/bin/env python3
 from __future__ import print_function
-import boto3, argparse, os, sys, json, time
+import boto3, argparse, csv, hashlib, os, random, re, sqlite3, sys, json, time, threading
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from sys import intern
 from botocore.exceptions import ClientError
 
+try:
+    import numpy
+except ImportError: # Optional, method evaluation falls back to Python ints
+    numpy = None
+
+# Permissions that are checked for each user, and the combinations of them that allow privilege escalation
+all_perms = [
+    'iam:AddUserToGroup',
+    'iam:AttachGroupPolicy',
+    'iam:AttachRolePolicy',
+    'iam:AttachUserPolicy',
+    'iam:CreateAccessKey',
+    'iam:CreatePolicyVersion',
+    'iam:CreateLoginProfile',
+    'iam:PassRole',
+    'iam:PutGroupPolicy',
+    'iam:PutRolePolicy',
+    'iam:PutUserPolicy',
+    'iam:SetDefaultPolicyVersion',
+    'iam:UpdateAssumeRolePolicy',
+    'iam:UpdateLoginProfile',
+    'sts:AssumeRole',
+    'ec2:RunInstances',
+    'lambda:CreateEventSourceMapping',
+    'lambda:CreateFunction',
+    'lambda:InvokeFunction',
+    'lambda:UpdateFunctionCode',
+    'dynamodb:CreateTable',
+    'dynamodb:PutItem',
+    'glue:CreateDevEndpoint',
+    'glue:UpdateDevEndpoint',
+    'cloudformation:CreateStack',
+    'datapipeline:CreatePipeline'
+]
+
+escalation_methods = {
+    'CreateNewPolicyVersion': {
+        'iam:CreatePolicyVersion': True
+    },
+    'SetExistingDefaultPolicyVersion': {
+        'iam:SetDefaultPolicyVersion': True
+    },
+    'CreateEC2WithExistingIP': {
+        'iam:PassRole': True,
+        'ec2:RunInstances': True
+    },
+    'CreateAccessKey': {
+        'iam:CreateAccessKey': True
+    },
+    'CreateLoginProfile': {
+        'iam:CreateLoginProfile': True
+    },
+    'UpdateLoginProfile': {
+        'iam:UpdateLoginProfile': True
+    },
+    'AttachUserPolicy': {
+        'iam:AttachUserPolicy': True
+    },
+    'AttachGroupPolicy': {
+        'iam:AttachGroupPolicy': True
+    },
+    'AttachRolePolicy': {
+        'iam:AttachRolePolicy': True,
+        'sts:AssumeRole': True
+    },
+    'PutUserPolicy': {
+        'iam:PutUserPolicy': True
+    },
+    'PutGroupPolicy': {
+        'iam:PutGroupPolicy': True
+    },
+    'PutRolePolicy': {
+        'iam:PutRolePolicy': True,
+        'sts:AssumeRole': True
+    },
+    'AddUserToGroup': {
+        'iam:AddUserToGroup': True
+    },
+    'UpdateRolePolicyToAssumeIt': {
+        'iam:UpdateAssumeRolePolicy': True,
+        'sts:AssumeRole': True
+    },
+    'PassExistingRoleToNewLambdaThenInvoke': {
+        'iam:PassRole': True,
+        'lambda:CreateFunction': True,
+        'lambda:InvokeFunction': True
+    },
+    'PassExistingRoleToNewLambdaThenTriggerWithNewDynamo': {
+        'iam:PassRole': True,
+        'lambda:CreateFunction': True,
+        'lambda:CreateEventSourceMapping': True,
+        'dynamodb:CreateTable': True,
+        'dynamodb:PutItem': True
+    },
+    'PassExistingRoleToNewLambdaThenTriggerWithExistingDynamo': {
+        'iam:PassRole': True,
+        'lambda:CreateFunction': True,
+        'lambda:CreateEventSourceMapping': True
+    },
+    'PassExistingRoleToNewGlueDevEndpoint': {
+        'iam:PassRole': True,
+        'glue:CreateDevEndpoint': True
+    },
+    'UpdateExistingGlueDevEndpoint': {
+        'glue:UpdateDevEndpoint': True
+    },
+    'PassExistingRoleToCloudFormation': {
+        'iam:PassRole': True,
+        'cloudformation:CreateStack': True
+    },
+    'PassExistingRoleToNewDataPipeline': {
+        'iam:PassRole': True,
+        'datapipeline:CreatePipeline': True
+    },
+    'EditExistingLambdaFunctionWithRole': {
+        'lambda:UpdateFunctionCode': True
+    }
+}
+
 def main(args):
+    if args.to_matrix is not None:
+        # Post-process the long-format results of an earlier run into the legacy one-column-per-user CSV
+        matrix_path = os.path.splitext(args.to_matrix)[0] + '_matrix.csv'
+        write_matrix(args.to_matrix, matrix_path)
+        print('Matrix stored to ./{}'.format(matrix_path))
+        return
+
+    if args.accounts is not None:
+        scan_accounts(args)
+        return
+
+    if args.serve is not None:
+        serve(args)
+        return
+
+    # Users are evaluated and their results streamed to disk as soon as they are collected
+    now = time.time()
+    rate_limiter.configure(args.target_rps, args.max_throttle_retries)
+    table = MethodTable(escalation_methods, all_perms)
+    state = None
+    if args.state_file is not None and args.from_snapshot is None:
+        state = load_state(args.state_file)
+    inventory = None
+    if args.inventory is not None:
+        inventory = ResourceInventory(load_snapshot(args.inventory))
+        print('Rating findings against an inventory of {}.\n'.format(inventory.summary() or 'no resources'))
+    checkpoint = None
+    if (args.checkpoint_file is not None or args.resume is True) and args.from_snapshot is None:
+        resume = args.resume
+        if resume is True and args.save_snapshot is not None and args.bulk is not True:
+            print('--resume is ignored with --save-snapshot, resumed users would be missing their groups and policies.')
+            resume = False
+        checkpoint = CheckpointStore(args.checkpoint_file or 'all_user_privesc_checkpoint.sqlite', checkpoint_scope(args, inventory), resume, args.checkpoint_batch)
+        print('Checkpointing the scan to {}.\n'.format(checkpoint.path))
+    previous = state['Users'] if state is not None else None
+    if state is not None and state.get('Inventory') != (inventory.digest if inventory is not None else None):
+        previous = None # Results of the last run were rated against other resources
+    stream = ResultStream(
+        'all_user_privesc_scan_records_{}.{}'.format(now, args.output_format),
+        args.output_format,
+        table,
+        previous,
+        inventory=inventory,
+        checkpoint=checkpoint
+    )
+    streamed = args.from_snapshot is not None and args.parse_workers > 0 and os.path.isfile(args.from_snapshot) and is_authorization_details(args.from_snapshot)
+    if args.from_snapshot is not None and args.parse_workers > 0 and not streamed:
+        print('{} is not a single authorization details dump, it is loaded whole instead of streamed.'.format(args.from_snapshot))
+    if streamed:
+        # Large dumps are read a record at a time and parsed in worker processes, only the results are kept
+        print('Streaming snapshot {}...'.format(args.from_snapshot))
+        with metrics.phase('collect'):
+            count = stream_snapshot(args.from_snapshot, stream, args.parse_workers, [args.user_name] if args.user_name is not None else None, inventory)
+        print('  Parsed and evaluated {} users.'.format(count))
+        print('  Done.\n')
+        users = None
+        roles = []
+    elif args.from_snapshot is not None:
+        # Offline analysis of saved IAM data, no credentials or API calls needed
+        print('Loading snapshot {}...'.format(args.from_snapshot))
+        with metrics.phase('collect'):
+            details = load_snapshot(args.from_snapshot)
+            users = users_from_authorization_details(details, [args.user_name] if args.user_name is not None else None)
+            roles = roles_from_authorization_details(details)
+        print('  Parsed {} users, {} groups, {} roles and {} managed policies.'.format(len(users), len(details['GroupDetailList']), len(roles), len(details['Policies'])))
+        print('  Done.\n')
+        stream.batch_size = 1000 # Everything is already in memory, evaluate it in large vectorized batches
+        for user in users:
+            stream.add(user)
+    else:
+        try:
+            users, roles = collect_live_users(args, state, stream.add, checkpoint)
+        finally:
+            if checkpoint is not None:
+                checkpoint.commit() # Keep the users finished before an error, a rerun with --resume starts after them
+    stream.close()
+    if checkpoint is not None:
+        checkpoint.close()
+    if args.roles_file is not None:
+        roles += roles_from_authorization_details(load_snapshot(args.roles_file))
+    if users is None and (args.trust is True or args.paths is True):
+        print('--trust and --paths need every principal in memory, they are skipped with --parse-workers.')
+    if checkpoint is not None and stream.resumed > 0:
+        print('Resumed the results of {} users from {}.'.format(stream.resumed, checkpoint.path))
+    if state is not None:
+        print('Reused the results of {} unchanged users, rescanned {}.'.format(stream.reused, len(users) - stream.reused))
+    if inventory is not None:
+        print('Resources in the inventory upgraded {} findings to confirmed and ruled out {}.'.format(inventory.upgraded, inventory.dropped))
+    print('Privilege escalation check completed. Results stored to ./{}'.format(stream.path))
+    if args.matrix is True:
+        with metrics.phase('output'):
+            write_matrix(stream.path, 'all_user_privesc_scan_results_{}.csv'.format(now), [user['UserName'] for user in users] if users is not None else None)
+        print('Matrix of results stored to ./all_user_privesc_scan_results_{}.csv'.format(now))
+
+    if state is not None:
+        diff = diff_results(state['Users'], users)
+        print('\nChanges since the last run: {} new users, {} removed users, {} users with changed results.'.format(len(diff['AddedUsers']), len(diff['RemovedUsers']), len(diff['Changed'])))
+        for user_name, changes in sorted(diff['Changed'].items()):
+            for method, (before, after) in sorted(changes.items()):
+                print('  {}: {} {} -> {}'.format(user_name, method, before or 'none', after or 'none'))
+        with open('all_user_privesc_diff_{}.json'.format(now), 'w') as f:
+            json.dump(diff, f, indent=2)
+        print('Diff stored to ./all_user_privesc_diff_{}.json'.format(now))
+        state['Users'] = dict((user['UserName'], {'Fingerprint': user.get('Fingerprint'), 'CheckedMethods': user['CheckedMethods']}) for user in users)
+        state['Inventory'] = inventory.digest if inventory is not None else None
+        save_state(state, args.state_file)
+
+    if args.trust is True and users is not None:
+        # Roles whose trust policies let in more than one identity, and the roles each scanned user can assume
+        print('\nIndexing the trust policies of {} roles...'.format(len(roles)))
+        with metrics.phase('trust'):
+            trust = TrustIndex(roles)
+            assumable = {}
+            for user in users:
+                checked_perms = check_permissions(user['Permissions'], ['sts:AssumeRole'])
+                roles_for_user = trust.assumable(user, checked_perms['Allow'].get('sts:AssumeRole'), checked_perms['Deny'].get('sts:AssumeRole', []))
+                if roles_for_user != []:
+                    assumable[user['UserName']] = roles_for_user
+        print('  {}.'.format(trust.summary()))
+        for finding in trust.findings:
+            print('  {}: {} ({}{})'.format(finding['Role'], finding['Issue'], finding['Principal'], ', with conditions' if finding['Conditional'] else ''))
+        print('  {} users can assume at least one role.'.format(len(assumable)))
+        federated = trust.federated_roles()
+        for provider, subjects in sorted(federated.items()):
+            print('  {}: {} subjects can assume up to {} roles.'.format(provider, len(subjects), len(set(role for roles in subjects.values() for role in roles))))
+        with open('all_user_privesc_trust_{}.json'.format(now), 'w') as f:
+            json.dump({'Findings': trust.findings, 'Assumable': assumable, 'Federated': federated}, f, indent=2)
+        print('Trust analysis stored to ./all_user_privesc_trust_{}.json'.format(now))
+
+    if args.paths is True and users is not None:
+        # Multi-hop search through other users and roles, with '?' marking steps that are only potential
+        print('\nSearching for escalation paths through {} users and {} roles (max depth {})...'.format(len(users), len(roles), args.max_depth))
+        with metrics.phase('paths'):
+            graph = EscalationGraph(users, roles, table).solve(args.max_depth)
+        paths = {}
+        for user in users:
+            steps = graph.path(user)
+            if steps is None or steps == []:
+                continue
+            paths[user['UserName']] = {
+                'Depth': len(steps),
+                'Confirmed': all(step['Confirmed'] for step in steps),
+                'Steps': steps
+            }
+            print('  {}'.format(format_path(steps)))
+        if paths == {}:
+            print('  No paths to admin found.')
+        with open('all_user_privesc_paths_{}.json'.format(now), 'w') as f:
+            json.dump(paths, f, indent=2)
+        print('Escalation paths stored to ./all_user_privesc_paths_{}.json'.format(now))
+
+    print('\n{}'.format(metrics.report()))
+    print(rate_limiter.summary())
+    with open('all_user_privesc_metrics_{}.json'.format(now), 'w') as f:
+        json.dump(metrics.summary(), f, indent=2)
+    print('Metrics stored to ./all_user_privesc_metrics_{}.json'.format(now))
+    if args.prometheus_file is not None:
+        metrics.write_prometheus(args.prometheus_file)
+        print('Prometheus metrics stored to {}'.format(args.prometheus_file))
+
+# Enumerate the target users and collect their permissions from the live IAM API. Roles are only collected in --bulk mode
+def collect_live_users(args, state=None, on_user=None, checkpoint=None):
+    client_factory = live_client_factory(args)
+    with metrics.phase('collect'):
+        return collect_users(client_factory, args, state, on_user, checkpoint)
+
+# IAM clients for the keys passed on the command line, asking for them when they were not
+def live_client_factory(args):
     access_key_id = args.access_key_id
     secret_access_key = args.secret_key
     session_token = args.session_token
@@ -15,117 +309,605 @@ def main(args):
         session_token = input('  Session Token (Leave blank if none): ')
         if session_token.strip() == '':
             session_token = None
+    return lambda: create_iam_client(access_key_id, secret_access_key, session_token)
 
+# Enumerate the target users with clients from client_factory and collect their permissions. With a checkpoint, users it
+# already holds results for are taken from it instead of being collected again
+def collect_users(client_factory, args, state=None, on_user=None, checkpoint=None):
     # Begin permissions enumeration
     current_user = None
     users = []
-    client = boto3.client(
-        'iam',
+    roles = []
+    client = client_factory()
+    if args.bulk is True:
+        # Pull the whole account in a handful of paginated calls and resolve groups and managed policies locally
+        print('Downloading account authorization details...')
+        details = get_account_authorization_details(client)
+        if args.all_users is True:
+            user_names = None
+        elif args.user_name is not None:
+            user_names = [args.user_name]
+        else:
+            user_names = [client.get_user()['User']['UserName']]
+        users = users_from_authorization_details(details, user_names)
+        roles = roles_from_authorization_details(details)
+        print('  Parsed {} users, {} groups, {} roles and {} managed policies.'.format(len(users), len(details['GroupDetailList']), len(roles), len(details['Policies'])))
+        if state is not None:
+            fingerprints = detail_fingerprints(details)
+            for user in users:
+                user['Fingerprint'] = fingerprints.get(user['UserName'])
+        if checkpoint is not None:
+            checkpoint.resume_users(users)
+        if on_user is not None:
+            for user in users:
+                on_user(user)
+    else:
+        if args.all_users is True:
+            # With a checkpoint every page is recorded with the marker of the next one, a resumed run lists from there on
+            listed, marker, done = checkpoint.listing() if checkpoint is not None else ([], None, False)
+            while not done:
+                response = client.list_users(Marker=marker) if marker is not None else client.list_users()
+                page = [{'UserName': user['UserName'], 'Arn': user['Arn']} for user in response['Users']]
+                marker = response['Marker'] if 'IsTruncated' in response and response['IsTruncated'] is True else None
+                done = marker is None
+                if checkpoint is not None:
+                    checkpoint.add_listed(page, marker)
+                listed += page
+            for user in listed:
+                users.append({'UserName': user['UserName'], 'Arn': user['Arn'], 'Permissions': {'Allow': {}, 'Deny': {}}})
+        elif args.user_name is not None:
+            users.append({'UserName': args.user_name, 'Permissions': {'Allow': {}, 'Deny': {}}})
+        else:
+            current_user = client.get_user()['User']
+            current_user = {
+                'UserName': current_user['UserName'],
+                'Arn': current_user['Arn'],
+                'Permissions': {
+                    'Allow': {},
+                    'Deny': {}
+                }
+            }
+            users.append(current_user)
+        print('Collecting policies for {} users...'.format(len(users)))
+        pending = list(range(len(users)))
+        if checkpoint is not None:
+            resumed = checkpoint.resume_users(users)
+            pending = [index for index in pending if index not in resumed]
+            for index in sorted(resumed):
+                if on_user is not None:
+                    on_user(users[index])
+            print('  {} users are already done in the checkpoint, {} left to collect.'.format(len(resumed), len(pending)))
+        if args.lazy is True and args.save_snapshot is not None:
+            print('  --lazy is ignored with --save-snapshot, a snapshot needs every policy.')
+        cache = PolicyCache(
+            keep_details=args.save_snapshot is not None or state is not None,
+            lazy=args.lazy is True and args.save_snapshot is None
+        )
+        if state is not None:
+            reused = seed_cache_from_state(client, cache, state)
+            print('  {} of {} attached managed policies are unchanged since the last run.'.format(reused, len(cache.default_versions)))
+
+        def collected(user):
+            if state is not None:
+                user['Fingerprint'] = user_fingerprint(user, cache)
+            if on_user is not None:
+                on_user(user)
+
+        if args.workers > 1:
+            remaining = collect_users_concurrently(
+                client_factory,
+                [users[index] for index in pending],
+                args.workers,
+                cache,
+                collected
+            )
+            for index, user in zip(pending, remaining):
+                users[index] = user
+        else:
+            for index in pending:
+                users[index] = collect_user_permissions(client, users[index], cache)
+                collected(users[index])
+        print('  {}'.format(cache.summary()))
+        if state is not None:
+            state['Policies'] = dict((policy_arn, {
+                'DefaultVersionId': version,
+                'UpdateDate': cache.update_dates.get(policy_arn),
+                'Document': document
+            }) for (policy_arn, version), document in cache.documents.items())
+    print('  Done.\n')
+
+    if args.save_snapshot is not None:
+        if args.bulk is not True:
+            details = authorization_details_from_collection(users, cache)
+        save_snapshot(details, args.save_snapshot)
+        print('Saved snapshot of {} users to {}\n'.format(len(details['UserDetailList']), args.save_snapshot))
+    return users, roles
+
+# Profiles or role ARNs to scan with --accounts, one per line. Blank lines and lines starting with '#' are skipped
+def load_account_targets(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() != '' and not line.strip().startswith('#')]
+
+# A boto3 session for one --accounts target: a role ARN is assumed with the credentials passed on the command line (or the
+# default credential chain), anything else is used as a profile name
+def account_session(target, args):
+    if target.startswith('arn:'):
+        base = boto3.session.Session(
+            aws_access_key_id=args.access_key_id,
+            aws_secret_access_key=args.secret_key,
+            aws_session_token=args.session_token
+        )
+        credentials = base.client('sts').assume_role(
+            RoleArn=target,
+            RoleSessionName='aws-escalate'
+        )['Credentials']
+        return boto3.session.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken']
+        )
+    return boto3.session.Session(profile_name=target)
+
+# Scan one account in a worker process. Its output goes to a log file in output_dir and its results are streamed to a
+# records file there, which the parent merges. Up to args.workers threads collect users within the account
+def scan_account(target, args, output_dir):
+    label = re.sub('[^A-Za-z0-9_.-]', '_', target)
+    log_path = os.path.join(output_dir, '{}.log'.format(label))
+    metrics.reset() # A pool process may scan several accounts in turn
+    rate_limiter.configure(args.target_rps, args.max_throttle_retries)
+    with open(log_path, 'w') as log, redirect_stdout(log):
+        try:
+            session = account_session(target, args)
+            account_id = session.client('sts').get_caller_identity()['Account']
+            credentials = session.get_credentials().get_frozen_credentials()
+            stream = ResultStream(
+                os.path.join(output_dir, '{}.jsonl'.format(label)),
+                'jsonl',
+                MethodTable(escalation_methods, all_perms)
+            )
+            with metrics.phase('collect'):
+                users, roles = collect_users(lambda: create_iam_client(credentials.access_key, credentials.secret_key, credentials.token), args, None, stream.add)
+            stream.close()
+        except Exception as e:
+            print('Error, skipping account {}:\n{}'.format(target, e))
+            return {'Target': target, 'Account': None, 'Error': str(e), 'Log': log_path}
+        print('\n{}'.format(metrics.report()))
+        print(rate_limiter.summary())
+    with open(os.path.join(output_dir, '{}.metrics.json'.format(label)), 'w') as f:
+        json.dump(metrics.summary(), f, indent=2)
+    return {'Target': target, 'Account': account_id, 'Users': len(users), 'Records': stream.path, 'Log': log_path}
+
+# Scan every account from --accounts in parallel on a process pool, one session per account, and merge the results into one
+# long-format file keyed by account ID as each account finishes
+def scan_accounts(args):
+    now = time.time()
+    targets = load_account_targets(args.accounts)
+    output_dir = 'multi_account_privesc_{}'.format(now)
+    os.mkdir(output_dir)
+    # Assumed roles have no IAM user of their own, so every account is scanned in full
+    args.all_users = True
+    args.save_snapshot = None
+    merged_path = 'multi_account_privesc_scan_records_{}.jsonl'.format(now)
+    print('Scanning {} accounts with {} processes, {} collection threads each...'.format(len(targets), args.account_workers, args.workers))
+    with open(merged_path, 'w') as merged, ProcessPoolExecutor(max_workers=args.account_workers) as executor:
+        futures = [executor.submit(scan_account, target, args, output_dir) for target in targets]
+        for future in as_completed(futures):
+            result = future.result()
+            if result['Account'] is None:
+                print('  {}... failed, see {}'.format(result['Target'], result['Log']))
+                continue
+            for record in read_records(result['Records']):
+                record['Account'] = result['Account']
+                merged.write(json.dumps(record) + '\n')
+            merged.flush()
+            print('  {} ({})... {} users done!'.format(result['Target'], result['Account'], result['Users']))
+    print('Multi-account scan completed. Results stored to ./{}, per-account logs and metrics in ./{}/'.format(merged_path, output_dir))
+
+# boto3 clients are not safe to share between threads, so each caller (or worker thread) gets its own session
+def create_iam_client(access_key_id, secret_access_key, session_token):
+    session = boto3.session.Session(
         aws_access_key_id=access_key_id,
         aws_secret_access_key=secret_access_key,
         aws_session_token=session_token
     )
-    if args.all_users is True:
-        response = client.list_users()
-        for user in response['Users']:
-            users.append({'UserName': user['UserName'], 'Permissions': {'Allow': {}, 'Deny': {}}})
-        while 'IsTruncated' in response and response['IsTruncated'] is True:
-            response = client.list_users(
-                Marker=response['Marker']
-            )
-            for user in response['Users']:
-                users.append({'UserName': user['UserName'], 'Permissions': {'Allow': {}, 'Deny': {}}})
-    elif args.user_name is not None:
-        users.append({'UserName': args.user_name, 'Permissions': {'Allow': {}, 'Deny': {}}})
-    else:
-        current_user = client.get_user()['User']
-        current_user = {
-            'UserName': current_user['UserName'],
-            'Permissions': {
-                'Allow': {},
-                'Deny': {}
+    return rate_limiter.attach(metrics.instrument(session.client('iam')))
+
+# Upper bounds in seconds of the IAM call latency histogram buckets, plus an implicit +Inf bucket
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Error codes AWS answers with when a call is rate limited
+throttle_codes = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException', 'RequestThrottled', 'SlowDown']
+
+# Call counts, latencies, retries, throttles and bytes per IAM operation, and time spent in each phase of the run
+class RunMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.operations = {} # Operation name -> counters and latency buckets
+            self.phases = {} # Phase name -> seconds
+
+    # Register the hooks on a boto3 client. Clients without botocore events (e.g. stand-ins in tests) are left as they are
+    def instrument(self, client):
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is not None:
+            events.register('before-parameter-build.iam', self.before_call)
+            events.register('needs-retry.iam', self.needs_retry)
+            events.register('after-call.iam', self.after_call)
+            events.register('after-call-error.iam', self.after_call_error)
+        return client
+
+    # Counters of one operation, the caller holds the lock
+    def operation(self, name):
+        if name not in self.operations:
+            self.operations[name] = {
+                'Calls': 0,
+                'Errors': 0,
+                'Retries': 0,
+                'Throttles': 0,
+                'Bytes': 0,
+                'Seconds': 0.0,
+                'Buckets': [0] * (len(latency_buckets) + 1)
             }
+        return self.operations[name]
+
+    # Registered on before-parameter-build rather than before-call, which stubs and other handlers may answer first
+    def before_call(self, model, context, **kwargs):
+        context['metrics_operation'] = model.name
+        context['metrics_start'] = time.perf_counter()
+
+    # Called after every attempt, including the last one, so each throttled response is counted once
+    def needs_retry(self, operation, response=None, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in throttle_codes:
+            with self.lock:
+                self.operation(operation.name)['Throttles'] += 1
+
+    def after_call(self, http_response, parsed, model, context, **kwargs):
+        self.record(
+            model.name,
+            context,
+            http_response.status_code >= 300,
+            parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+            int(http_response.headers.get('content-length', 0))
+        )
+
+    # Connection errors and timeouts that botocore gave up on
+    def after_call_error(self, context, **kwargs):
+        self.record(context.get('metrics_operation', 'Unknown'), context, True, 0, 0)
+
+    def record(self, name, context, error, retries, size):
+        seconds = time.perf_counter() - context['metrics_start'] if 'metrics_start' in context else 0.0
+        with self.lock:
+            operation = self.operation(name)
+            operation['Calls'] += 1
+            operation['Errors'] += 1 if error is True else 0
+            operation['Retries'] += retries
+            operation['Bytes'] += size
+            operation['Seconds'] += seconds
+            operation['Buckets'][bisect_left(latency_buckets, seconds)] += 1
+
+    # Add the wall time of the block to a phase
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def summary(self):
+        with self.lock:
+            operations = {}
+            for name, operation in sorted(self.operations.items()):
+                operations[name] = dict((key, value) for key, value in operation.items() if key != 'Buckets')
+                operations[name]['LatencyBuckets'] = dict(zip(
+                    ['<={}'.format(bound) for bound in latency_buckets] + ['>{}'.format(latency_buckets[-1])],
+                    operation['Buckets']
+                ))
+            return {
+                'Started': self.started,
+                'WallSeconds': time.time() - self.started,
+                'Phases': dict(self.phases),
+                'Totals': dict((key, sum(operation[key] for operation in self.operations.values())) for key in ['Calls', 'Errors', 'Retries', 'Throttles', 'Bytes', 'Seconds']),
+                'Operations': operations
+            }
+
+    # A few lines for the console: totals, phases and the operations that took the most time
+    def report(self):
+        summary = self.summary()
+        totals = summary['Totals']
+        lines = ['IAM calls: {} in {:.1f}s, {} errors, {} retries, {} throttled, {:.1f} KB received'.format(
+            totals['Calls'],
+            totals['Seconds'],
+            totals['Errors'],
+            totals['Retries'],
+            totals['Throttles'],
+            totals['Bytes'] / 1024.0
+        )]
+        for name, operation in sorted(summary['Operations'].items(), key=lambda item: -item[1]['Seconds'])[:5]:
+            lines.append('  {}: {} calls, {:.1f}s, {:.0f} ms average'.format(name, operation['Calls'], operation['Seconds'], operation['Seconds'] * 1000.0 / operation['Calls']))
+        lines.append('Phases: {}'.format(', '.join('{} {:.1f}s'.format(name, seconds) for name, seconds in sorted(summary['Phases'].items()))))
+        return '\n'.join(lines)
+
+    # Prometheus text exposition format, written to a temporary file first so a textfile collector never reads half of it
+    def write_prometheus(self, path):
+        with self.lock:
+            operations = dict((name, dict(operation, Buckets=list(operation['Buckets']))) for name, operation in self.operations.items())
+            phases = dict(self.phases)
+        lines = []
+        for key, metric, description in [
+            ('Calls', 'aws_escalate_iam_calls_total', 'IAM API calls by operation.'),
+            ('Errors', 'aws_escalate_iam_errors_total', 'IAM API calls that failed.'),
+            ('Retries', 'aws_escalate_iam_retries_total', 'Retries botocore made for IAM API calls.'),
+            ('Throttles', 'aws_escalate_iam_throttles_total', 'Throttled IAM API responses.'),
+            ('Bytes', 'aws_escalate_iam_received_bytes_total', 'Bytes received in IAM API responses.')
+        ]:
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} counter'.format(metric))
+            for name, operation in sorted(operations.items()):
+                lines.append('{}{{operation="{}"}} {}'.format(metric, name, operation[key]))
+        metric = 'aws_escalate_iam_call_duration_seconds'
+        lines.append('# HELP {} IAM API call latency, including retries.'.format(metric))
+        lines.append('# TYPE {} histogram'.format(metric))
+        for name, operation in sorted(operations.items()):
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in latency_buckets] + ['+Inf'], operation['Buckets']):
+                cumulative += count
+                lines.append('{}_bucket{{operation="{}",le="{}"}} {}'.format(metric, name, bound, cumulative))
+            lines.append('{}_sum{{operation="{}"}} {}'.format(metric, name, operation['Seconds']))
+            lines.append('{}_count{{operation="{}"}} {}'.format(metric, name, operation['Calls']))
+        metric = 'aws_escalate_phase_duration_seconds'
+        lines.append('# HELP {} Time spent in each phase of the run, summed over threads.'.format(metric))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for name, seconds in sorted(phases.items()):
+            lines.append('{}{{phase="{}"}} {}'.format(metric, name, seconds))
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+# Metrics of the current run, shared by every thread
+metrics = RunMetrics()
+
+# Token bucket shared by every IAM client, lowered on throttling and raised back towards the target rate
+class RateLimiter(object):
+    def __init__(self, target_rps=None, max_retries=10):
+        self.lock = threading.Lock()
+        self.configure(target_rps, max_retries)
+
+    # target_rps None or 0 only retries throttled calls, without limiting the rate
+    def configure(self, target_rps, max_retries=10):
+        with self.lock:
+            self.target_rps = float(target_rps) if target_rps else None
+            self.max_retries = max_retries
+            self.rate = self.target_rps
+            self.tokens = 1.0
+            self.updated = time.monotonic()
+            self.decreased = 0.0
+            self.throttles = 0
+            self.requeued = 0
+
+    def attach(self, client):
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is not None:
+            events.register('before-send.iam', self.before_send)
+            # Ahead of botocore's own retry handler, whose first non-None answer decides the delay
+            events.register_first('needs-retry.iam', self.needs_retry)
+        return client
+
+    # Take a token before every HTTP attempt, retries included. Tokens are reserved in arrival order, so waiting callers
+    # queue up behind each other instead of racing
+    def acquire(self):
+        with self.lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def before_send(self, **kwargs):
+        self.acquire()
+
+    def needs_retry(self, attempts, response=None, **kwargs):
+        if response is None: # Connection errors are left to botocore
+            return None
+        code = response[1].get('Error', {}).get('Code')
+        with self.lock:
+            if code not in throttle_codes:
+                if code is None and self.rate is not None and self.rate < self.target_rps:
+                    self.rate = min(self.target_rps, self.rate + 1.0 / self.rate)
+                return None
+            self.throttles += 1
+            now = time.monotonic()
+            if self.rate is not None and now - self.decreased >= 1.0:
+                self.rate = max(0.5, self.rate * 0.7)
+                self.decreased = now
+            if attempts > self.max_retries:
+                return None
+            self.requeued += 1
+        backoff = min(20.0, 0.5 * 2 ** (attempts - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def summary(self):
+        with self.lock:
+            if self.rate is None:
+                return 'Rate limiter: no target rate, {} throttled responses, {} calls retried'.format(self.throttles, self.requeued)
+            return 'Rate limiter: {:.1f} of {:.1f} requests per second at the end, {} throttled responses, {} calls retried'.format(
+                self.rate,
+                self.target_rps,
+                self.throttles,
+                self.requeued
+            )
+
+# Request rate shared by every thread, configured from --target-rps
+rate_limiter = RateLimiter()
+
+# Collect users on a bounded thread pool, each worker thread lazily creating its own client. Each entry of users is replaced
+# with its finalized principal, and on_user is called from the calling thread for each user as soon as it is done
+def collect_users_concurrently(client_factory, users, workers, cache=None, on_user=None):
+    local = threading.local()
+
+    def collect(user):
+        if getattr(local, 'client', None) is None:
+            local.client = client_factory()
+        return collect_user_permissions(local.client, user, cache)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(collect, user), index) for index, user in enumerate(users))
+        for future in as_completed(futures):
+            user = future.result()
+            users[futures[future]] = user
+            if on_user is not None:
+                on_user(user)
+    return users
+
+# In-process cache shared by every worker thread. Managed policy documents are keyed by (PolicyArn, DefaultVersionId)
+# and groups are memoized as their already parsed Allow/Deny maps, so each distinct policy and group is only fetched once
+class PolicyCache(object):
+    def __init__(self, keep_details=False, lazy=False):
+        self.keep_details = keep_details # Keep the raw policies of each principal so the run can be saved as a snapshot
+        self.lazy = lazy # Stop collecting a principal once its results are settled
+        self.skipped = 0 # API calls lazy collection did not need to make, at least
+        self.lock = threading.Lock()
+        self.default_versions = {} # PolicyArn -> DefaultVersionId
+        self.documents = {} # (PolicyArn, DefaultVersionId) -> policy document
+        self.groups = {} # GroupName -> {'Permissions': ..., 'PermissionsConfirmed': ...}
+        self.update_dates = {} # PolicyArn -> UpdateDate, when known from ListPolicies
+        self.loading = {} # (store name, key) -> threading.Event for lookups another thread is already fetching
+        self.stats = {
+            'documents': {'hits': 0, 'misses': 0},
+            'groups': {'hits': 0, 'misses': 0}
         }
-        users.append(current_user)
-    print('Collecting policies for {} users...'.format(len(users)))
-    for user in users:
-        user['Groups'] = []
-        user['Policies'] = []
+
+    # Return store[key], calling loader() on a miss. Concurrent misses on the same key wait for the first one
+    # instead of fetching it again. Loaders return False on failure, which is not cached
+    def memoize(self, name, store, key, loader, stat=None):
+        while True:
+            with self.lock:
+                if key in store:
+                    if stat is not None:
+                        self.stats[stat]['hits'] += 1
+                    return store[key]
+                event = self.loading.get((name, key))
+                if event is None:
+                    event = threading.Event()
+                    self.loading[(name, key)] = event
+                    break
+            event.wait()
+            with self.lock:
+                if key not in store: # The other thread failed, try to load it ourselves
+                    continue
         try:
-            policies = []
+            value = loader()
+            with self.lock:
+                if stat is not None:
+                    self.stats[stat]['misses'] += 1
+                if value is not False:
+                    store[key] = value
+            return value
+        finally:
+            with self.lock:
+                self.loading.pop((name, key), None)
+            event.set()
+
+    def get_default_version(self, client, policy_arn):
+        def load():
+            try:
+                return client.get_policy(
+                    PolicyArn=policy_arn
+                )['Policy']['DefaultVersionId']
+            except Exception as e:
+                print('Get policy failed: {}'.format(e))
+                return False
+        return self.memoize('default_versions', self.default_versions, policy_arn, load)
 
-            ## Get groups that the user is in
+    def get_document(self, client, policy_arn, version):
+        def load():
             try:
+                document = client.get_policy_version(
+                    PolicyArn=policy_arn,
+                    VersionId=version
+                )['PolicyVersion']['Document']
+            except Exception as e:
+                print('Get policy version failed: {}'.format(e))
+                return False
+            return document
+        return self.memoize('documents', self.documents, (policy_arn, version), load, 'documents')
+
+    def get_group(self, client, group_name):
+        return self.memoize('groups', self.groups, group_name, lambda: collect_group_permissions(client, group_name, self), 'groups')
+
+    def summary(self):
+        summary = 'Policy cache: {} document hits, {} misses; {} group hits, {} misses'.format(
+            self.stats['documents']['hits'],
+            self.stats['documents']['misses'],
+            self.stats['groups']['hits'],
+            self.stats['groups']['misses']
+        )
+        if self.lazy is True:
+            summary += '; at least {} API calls skipped for settled principals'.format(self.skipped)
+        return summary
+
+    def settled(self, principal):
+        return self.lazy is True and permissions_settled(principal, all_perms)
+
+    def skip(self, calls):
+        with self.lock:
+            self.skipped += calls
+
+    # Calls needed to fetch an attached policy that is not in the cache yet
+    def policy_calls(self, policy_arn):
+        version = self.default_versions.get(policy_arn)
+        if version is None:
+            return 2
+        return 0 if (policy_arn, version) in self.documents else 1
+
+# Fetch the groups, inline policies and attached policies of a single user and parse them into user['Permissions']
+def collect_user_permissions(client, user, cache=None):
+    if cache is None:
+        cache = PolicyCache()
+    user['Groups'] = []
+    user['Policies'] = []
+    try:
+        ## Get groups that the user is in
+        try:
+            res = client.list_groups_for_user(
+                UserName=user['UserName']
+            )
+            user['Groups'] = res['Groups']
+            while 'IsTruncated' in res and res['IsTruncated'] is True:
                 res = client.list_groups_for_user(
-                    UserName=user['UserName']
+                    UserName=user['UserName'],
+                    Marker=res['Marker']
                 )
-                user['Groups'] = res['Groups']
-                while 'IsTruncated' in res and res['IsTruncated'] is True:
-                    res = client.list_groups_for_user(
-                        UserName=user['UserName'],
-                        Marker=groups['Marker']
-                    )
-                    user['Groups'] += res['Groups']
-            except Exception as e:
-                print('List groups for user failed: {}'.format(e))
+                user['Groups'] += res['Groups']
+        except Exception as e:
+            print('List groups for user failed: {}'.format(e))
+            user['PermissionsConfirmed'] = False
+
+        ## Merge in the permissions of each group, which are only fetched and parsed once per run
+        for index, group in enumerate(user['Groups']):
+            if cache.settled(user):
+                cache.skip(sum(2 for group in user['Groups'][index:] if group['GroupName'] not in cache.groups))
+                break
+            group_permissions = cache.get_group(client, group['GroupName'])
+            user = merge_permissions(user, group_permissions)
+            if group_permissions.get('PermissionsConfirmed') is False:
                 user['PermissionsConfirmed'] = False
 
-            ## Get inline and attached group policies
-            for group in user['Groups']:
-                group['Policies'] = []
-                ## Get inline group policies
-                try:
-                    res = client.list_group_policies(
-                        GroupName=group['GroupName']
-                    )
-                    policies = res['PolicyNames']
-                    while 'IsTruncated' in res and res['IsTruncated'] is True:
-                        res = client.list_group_policies(
-                            GroupName=group['GroupName'],
-                            Marker=res['Marker']
-                        )
-                        policies += res['PolicyNames']
-                except Exception as e:
-                    print('List group policies failed: {}'.format(e))
-                    user['PermissionsConfirmed'] = False
-                # Get document for each inline policy
-                for policy in policies:
-                    group['Policies'].append({ # Add policies to list of policies for this group
-                        'PolicyName': policy
-                    })
-                    try:
-                        document = client.get_group_policy(
-                            GroupName=group['GroupName'],
-                            PolicyName=policy
-                        )['PolicyDocument']
-                    except Exception as e:
-                        print('Get group policy failed: {}'.format(e))
-                        user['PermissionsConfirmed'] = False
-                    user = parse_document(document, user)
-
-                ## Get attached group policies
-                attached_policies = []
-                try:
-                    res = client.list_attached_group_policies(
-                        GroupName=group['GroupName']
-                    )
-                    attached_policies = res['AttachedPolicies']
-                    while 'IsTruncated' in res and res['IsTruncated'] is True:
-                        res = client.list_attached_group_policies(
-                            GroupName=group['GroupName'],
-                            Marker=res['Marker']
-                        )
-                        attached_policies += res['AttachedPolicies']
-                    group['Policies'] += attached_policies
-                except Exception as e:
-                    print('List attached group policies failed: {}'.format(e))
-                    user['PermissionsConfirmed'] = False
-                user = parse_attached_policies(client, attached_policies, user)
-
-            ## Get inline user policies
-            policies = []
-            if 'Policies' not in user:
-                user['Policies'] = []
+        ## Get inline user policies
+        policies = []
+        if cache.settled(user):
+            cache.skip(1)
+        else:
             try:
                 res = client.list_user_policies(
                     UserName=user['UserName']
@@ -144,19 +926,28 @@ def main(args):
             except Exception as e:
                 print('List user policies failed: {}'.format(e))
                 user['PermissionsConfirmed'] = False
-            # Get document for each inline policy
-            for policy in policies:
-                try:
-                    document = client.get_user_policy(
-                        UserName=user['UserName'],
-                        PolicyName=policy
-                    )['PolicyDocument']
-                except Exception as e:
-                    print('Get user policy failed: {}'.format(e))
-                    user['PermissionsConfirmed'] = False
-                user = parse_document(document, user)
-            ## Get attached user policies
-            attached_policies = []
+        # Get document for each inline policy
+        inline_policies = []
+        for index, policy in enumerate(policies):
+            if cache.settled(user):
+                cache.skip(len(policies) - index)
+                break
+            try:
+                document = client.get_user_policy(
+                    UserName=user['UserName'],
+                    PolicyName=policy
+                )['PolicyDocument']
+            except Exception as e:
+                print('Get user policy failed: {}'.format(e))
+                user['PermissionsConfirmed'] = False
+                continue
+            inline_policies.append({'PolicyName': policy, 'PolicyDocument': document})
+            user = parse_document(document, user)
+        ## Get attached user policies
+        attached_policies = []
+        if cache.settled(user):
+            cache.skip(1)
+        else:
             try:
                 res = client.list_attached_user_policies(
                     UserName=user['UserName']
@@ -172,199 +963,1580 @@ def main(args):
             except Exception as e:
                 print('List attached user policies failed: {}'.format(e))
                 user['PermissionsConfirmed'] = False
-            user = parse_attached_policies(client, attached_policies, user)
-            user.pop('Groups', None)
-            user.pop('Policies', None)
+        user = parse_attached_policies(client, attached_policies, user, cache)
+        if cache.keep_details is True:
+            user['Details'] = {
+                'UserName': user['UserName'],
+                'GroupList': [group['GroupName'] for group in user['Groups']],
+                'UserPolicyList': inline_policies,
+                'AttachedManagedPolicies': attached_policies
+            }
+            if user.get('Arn') is not None:
+                user['Details']['Arn'] = user['Arn']
+        user.pop('Groups', None)
+        user.pop('Policies', None)
+    except Exception as e:
+        print('Error, skipping user {}:\n{}'.format(user['UserName'], e))
+    user = finalize_permissions(user)
+    print('  {}... done!'.format(user['UserName']))
+    return user
+
+# Fetch and parse the inline and attached policies of a group into a standalone Allow/Deny map that can be merged into its members
+def collect_group_permissions(client, group_name, cache):
+    group = {'GroupName': group_name, 'Permissions': {'Allow': {}, 'Deny': {}}}
+    ## Get inline group policies
+    policies = []
+    try:
+        res = client.list_group_policies(
+            GroupName=group_name
+        )
+        policies = res['PolicyNames']
+        while 'IsTruncated' in res and res['IsTruncated'] is True:
+            res = client.list_group_policies(
+                GroupName=group_name,
+                Marker=res['Marker']
+            )
+            policies += res['PolicyNames']
+    except Exception as e:
+        print('List group policies failed: {}'.format(e))
+        group['PermissionsConfirmed'] = False
+    # Get document for each inline policy
+    inline_policies = []
+    for index, policy in enumerate(policies):
+        if cache.settled(group):
+            cache.skip(len(policies) - index)
+            break
+        try:
+            document = client.get_group_policy(
+                GroupName=group_name,
+                PolicyName=policy
+            )['PolicyDocument']
         except Exception as e:
-            print('Error, skipping user {}:\n{}'.format(user['UserName'], e))
-        print('  {}... done!'.format(user['UserName']))
+            print('Get group policy failed: {}'.format(e))
+            group['PermissionsConfirmed'] = False
+            continue
+        inline_policies.append({'PolicyName': policy, 'PolicyDocument': document})
+        group = parse_document(document, group)
 
-    print('  Done.\n')
+    ## Get attached group policies
+    attached_policies = []
+    if cache.settled(group):
+        cache.skip(1)
+    else:
+        try:
+            res = client.list_attached_group_policies(
+                GroupName=group_name
+            )
+            attached_policies = res['AttachedPolicies']
+            while 'IsTruncated' in res and res['IsTruncated'] is True:
+                res = client.list_attached_group_policies(
+                    GroupName=group_name,
+                    Marker=res['Marker']
+                )
+                attached_policies += res['AttachedPolicies']
+        except Exception as e:
+            print('List attached group policies failed: {}'.format(e))
+            group['PermissionsConfirmed'] = False
+    if cache.keep_details is True:
+        group['Details'] = {
+            'GroupName': group_name,
+            'GroupPolicyList': inline_policies,
+            'AttachedManagedPolicies': attached_policies
+        }
+    return finalize_permissions(parse_attached_policies(client, attached_policies, group, cache))
 
-    # Begin privesc scanning
-    all_perms = [
-        'iam:AddUserToGroup',
-        'iam:AttachGroupPolicy',
-        'iam:AttachRolePolicy',
-        'iam:AttachUserPolicy',
-        'iam:CreateAccessKey',
-        'iam:CreatePolicyVersion',
-        'iam:CreateLoginProfile',
-        'iam:PassRole',
-        'iam:PutGroupPolicy',
-        'iam:PutRolePolicy',
-        'iam:PutUserPolicy',
-        'iam:SetDefaultPolicyVersion',
-        'iam:UpdateAssumeRolePolicy',
-        'iam:UpdateLoginProfile',
-        'sts:AssumeRole',
-        'ec2:RunInstances',
-        'lambda:CreateEventSourceMapping',
-        'lambda:CreateFunction',
-        'lambda:InvokeFunction',
-        'lambda:UpdateFunctionCode',
-        'dynamodb:CreateTable',
-        'dynamodb:PutItem',
-        'glue:CreateDevEndpoint',
-        'glue:UpdateDevEndpoint',
-        'cloudformation:CreateStack',
-        'datapipeline:CreatePipeline'
-    ]
-
-    escalation_methods = {
-        'CreateNewPolicyVersion': {
-            'iam:CreatePolicyVersion': True
-        },
-        'SetExistingDefaultPolicyVersion': {
-            'iam:SetDefaultPolicyVersion': True
-        },
-        'CreateEC2WithExistingIP': {
-            'iam:PassRole': True,
-            'ec2:RunInstances': True
-        },
-        'CreateAccessKey': {
-            'iam:CreateAccessKey': True
-        },
-        'CreateLoginProfile': {
-            'iam:CreateLoginProfile': True
-        },
-        'UpdateLoginProfile': {
-            'iam:UpdateLoginProfile': True
-        },
-        'AttachUserPolicy': {
-            'iam:AttachUserPolicy': True
-        },
-        'AttachGroupPolicy': {
-            'iam:AttachGroupPolicy': True
-        },
-        'AttachRolePolicy': {
-            'iam:AttachRolePolicy': True,
-            'sts:AssumeRole': True
-        },
-        'PutUserPolicy': {
-            'iam:PutUserPolicy': True
-        },
-        'PutGroupPolicy': {
-            'iam:PutGroupPolicy': True
-        },
-        'PutRolePolicy': {
-            'iam:PutRolePolicy': True,
-            'sts:AssumeRole': True
-        },
-        'AddUserToGroup': {
-            'iam:AddUserToGroup': True
-        },
-        'UpdateRolePolicyToAssumeIt': {
-            'iam:UpdateAssumeRolePolicy': True,
-            'sts:AssumeRole': True
-        },
-        'PassExistingRoleToNewLambdaThenInvoke': {
-            'iam:PassRole': True,
-            'lambda:CreateFunction': True,
-            'lambda:InvokeFunction': True
-        },
-        'PassExistingRoleToNewLambdaThenTriggerWithNewDynamo': {
-            'iam:PassRole': True,
-            'lambda:CreateFunction': True,
-            'lambda:CreateEventSourceMapping': True,
-            'dynamodb:CreateTable': True,
-            'dynamodb:PutItem': True
-        },
-        'PassExistingRoleToNewLambdaThenTriggerWithExistingDynamo': {
-            'iam:PassRole': True,
-            'lambda:CreateFunction': True,
-            'lambda:CreateEventSourceMapping': True
-        },
-        'PassExistingRoleToNewGlueDevEndpoint': {
-            'iam:PassRole': True,
-            'glue:CreateDevEndpoint': True
-        },
-        'UpdateExistingGlueDevEndpoint': {
-            'glue:UpdateDevEndpoint': True
-        },
-        'PassExistingRoleToCloudFormation': {
-            'iam:PassRole': True,
-            'cloudformation:CreateStack': True
-        },
-        'PassExistingRoleToNewDataPipeline': {
-            'iam:PassRole': True,
-            'datapipeline:CreatePipeline': True
-        },
-        'EditExistingLambdaFunctionWithRole': {
-            'lambda:UpdateFunctionCode': True
+# Download every user, group, role and managed policy in the account through the paginated GetAccountAuthorizationDetails call
+def get_account_authorization_details(client):
+    details = {
+        'UserDetailList': [],
+        'GroupDetailList': [],
+        'RoleDetailList': [],
+        'Policies': []
+    }
+    paginator = client.get_paginator('get_account_authorization_details')
+    for page in paginator.paginate():
+        for key in details:
+            details[key] += page.get(key, [])
+    return details
+
+# Policy documents are URL-encoded JSON strings in the raw API response, boto3 normally decodes them already
+def load_policy_document(document):
+    if isinstance(document, str):
+        document = json.loads(unquote(document))
+    return document
+
+# Default version document of each managed policy in an authorization details feed
+def managed_policy_documents(details):
+    documents = {}
+    for policy in details.get('Policies', []):
+        for version in policy.get('PolicyVersionList', []):
+            if version.get('IsDefaultVersion') is True or version.get('VersionId') == policy.get('DefaultVersionId'):
+                documents[policy['Arn']] = load_policy_document(version['Document'])
+                break
+    return documents
+
+# Parse a principal's inline policies and attached managed policies from an authorization details feed
+def parse_principal_details(principal, inline_policies, attached_policies, documents):
+    for policy in inline_policies:
+        principal = parse_document(load_policy_document(policy['PolicyDocument']), principal)
+    for policy in attached_policies:
+        if policy['PolicyArn'] in documents:
+            principal = parse_document(documents[policy['PolicyArn']], principal)
+        else:
+            print('Managed policy {} is missing from the authorization details'.format(policy['PolicyArn']))
+            principal['PermissionsConfirmed'] = False
+    return principal
+
+# Each group of an authorization details feed parsed once, to be merged into its members
+def groups_from_authorization_details(details, documents):
+    groups = {}
+    for group in details.get('GroupDetailList', []):
+        groups[group['GroupName']] = finalize_permissions(parse_principal_details(
+            {'GroupName': group['GroupName'], 'Permissions': {'Allow': {}, 'Deny': {}}},
+            group.get('GroupPolicyList', []),
+            group.get('AttachedManagedPolicies', []),
+            documents
+        ))
+    return groups
+
+# One user of an authorization details feed, with the permissions of its groups merged in
+def user_from_details(detail, groups, documents):
+    user = {'UserName': detail['UserName'], 'Permissions': {'Allow': {}, 'Deny': {}}}
+    if 'Arn' in detail:
+        user['Arn'] = detail['Arn']
+    if 'UserPolicyList' not in detail and 'AttachedManagedPolicies' not in detail and 'GroupList' not in detail:
+        user['PermissionsConfirmed'] = False # From a ListUsers dump, only the user's existence is known
+    for group_name in detail.get('GroupList', []):
+        if group_name in groups:
+            user = merge_permissions(user, groups[group_name])
+            if groups[group_name].get('PermissionsConfirmed') is False:
+                user['PermissionsConfirmed'] = False
+        else:
+            print('Group {} is missing from the authorization details'.format(group_name))
+            user['PermissionsConfirmed'] = False
+    user = parse_principal_details(user, detail.get('UserPolicyList', []), detail.get('AttachedManagedPolicies', []), documents)
+    return finalize_permissions(user)
+
+# Build the per-user Permissions structure from an authorization details feed, resolving group membership and
+# managed policy default versions locally. user_names limits the result to those users, None returns every user
+def users_from_authorization_details(details, user_names=None):
+    documents = managed_policy_documents(details)
+    groups = groups_from_authorization_details(details, documents)
+    users = []
+    for detail in details.get('UserDetailList', []):
+        if user_names is not None and detail['UserName'] not in user_names:
+            continue
+        users.append(user_from_details(detail, groups, documents))
+    if user_names is not None:
+        for user_name in user_names:
+            if user_name not in [user['UserName'] for user in users]:
+                print('User {} is missing from the authorization details'.format(user_name))
+    return users
+
+# Roles from an authorization details feed, with their parsed permissions and trust policy. Roles that come from a
+# ListRoles dump only have a trust policy, their permissions are unknown and marked as unconfirmed
+def roles_from_authorization_details(details):
+    documents = managed_policy_documents(details)
+    roles = []
+    for detail in details.get('RoleDetailList', []):
+        role = {
+            'RoleName': detail['RoleName'],
+            'Permissions': {'Allow': {}, 'Deny': {}},
+            'AssumeRolePolicyDocument': load_policy_document(detail.get('AssumeRolePolicyDocument', {'Statement': []}))
         }
+        if 'Arn' in detail:
+            role['Arn'] = detail['Arn']
+        if 'RolePolicyList' not in detail and 'AttachedManagedPolicies' not in detail:
+            role['PermissionsConfirmed'] = False
+        role = parse_principal_details(role, detail.get('RolePolicyList', []), detail.get('AttachedManagedPolicies', []), documents)
+        roles.append(finalize_permissions(role))
+    return roles
+
+# Rebuild an authorization details document from a per-user collection run, so it can be saved in the same format as --bulk
+def authorization_details_from_collection(users, cache):
+    details = {
+        'UserDetailList': [user['Details'] for user in users if 'Details' in user],
+        'GroupDetailList': [group['Details'] for group in cache.groups.values() if 'Details' in group],
+        'RoleDetailList': [],
+        'Policies': []
+    }
+    for (policy_arn, version), document in cache.documents.items():
+        details['Policies'].append({
+            'PolicyName': policy_arn.split('/')[-1],
+            'Arn': policy_arn,
+            'DefaultVersionId': version,
+            'PolicyVersionList': [{
+                'Document': document,
+                'VersionId': version,
+                'IsDefaultVersion': True
+            }]
+        })
+    return details
+
+def save_snapshot(details, path):
+    with open(path, 'w') as f:
+        json.dump(details, f, indent=2, default=str) # default=str for the datetimes boto3 returns
+
+# Load saved IAM data into a single authorization details document. path may be a file or a directory of .json files, each one
+# holding either a GetAccountAuthorizationDetails dump (as written by --save-snapshot), a ListRoles dump such as all-roles.json,
+# a ListUsers or ListGroups dump, or a bare policy document for one principal such as policy-all.json. Bare identity policies become a user named after the
+# file and bare trust policies (statements with a Principal) become a role named after the file
+def load_snapshot(path):
+    details = {
+        'UserDetailList': [],
+        'GroupDetailList': [],
+        'RoleDetailList': [],
+        'Policies': []
     }
-    import re
-    for user in users:
-        print('User: {}'.format(user['UserName']))
-        checked_perms = {'Allow': {}, 'Deny': {}}
-        # Preliminary check to see if these permissions have already been enumerated in this session
-        if 'Permissions' in user and 'Allow' in user['Permissions']:
-            # Are they an admin already?
-            if '*' in user['Permissions']['Allow'] and user['Permissions']['Allow']['*'] == ['*']:
-                user['CheckedMethods'] = {'admin': {}, 'Confirmed':{}, 'Potential': {}}
-                print('  Already an admin!\n')
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.json')]
+    else:
+        files = [path]
+    for file_path in files:
+        with open(file_path) as f:
+            data = json.load(f)
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        if any(key in data for key in details):
+            for key in details:
+                details[key] += data.get(key, [])
+        elif 'Roles' in data:
+            details['RoleDetailList'] += data['Roles']
+        elif 'Users' in data or 'Groups' in data:
+            details['UserDetailList'] += data.get('Users', [])
+            details['GroupDetailList'] += data.get('Groups', [])
+        elif 'Statement' in data:
+            statements = data['Statement'] if type(data['Statement']) is list else [data['Statement']]
+            if any('Principal' in statement or 'NotPrincipal' in statement for statement in statements):
+                details['RoleDetailList'].append({
+                    'RoleName': name,
+                    'AssumeRolePolicyDocument': data
+                })
+            else:
+                details['UserDetailList'].append({
+                    'UserName': name,
+                    'GroupList': [],
+                    'UserPolicyList': [{'PolicyName': name, 'PolicyDocument': data}],
+                    'AttachedManagedPolicies': []
+                })
+        else:
+            print('Skipping {}, not a recognized IAM snapshot'.format(file_path))
+    return details
+
+# Reads one JSON document from a file in chunks and decodes it a value at a time, so only the current chunk and the value being
+# decoded are held in memory. The caller walks the structure with peek() and expect() and decodes the values it wants
+class JsonStream(object):
+    def __init__(self, file, chunk_size=1 << 20):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    # Read the next chunk, dropping what was already consumed. False at the end of the file
+    def fill(self):
+        chunk = self.file.read(self.chunk_size)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return chunk != ''
+
+    # The next character that is not whitespace, without consuming it, or '' at the end of the file
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+                self.position += 1
+            if self.position < len(self.buffer) or not self.fill():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected {!r} in the JSON document, found {!r}'.format(char, self.peek()))
+        self.position += 1
+
+    # Decode the next value, reading more chunks until it is complete. A value ending right at the end of the buffer is read
+    # further too, as a number could go on in the next chunk
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.position = end
+            return value
+
+# The lists of an authorization details document, whose elements are streamed one at a time
+detail_lists = ['UserDetailList', 'GroupDetailList', 'RoleDetailList', 'Policies']
+
+# (list name, record) for each element of the detail lists of an authorization details dump, in file order, without loading
+# the whole file. Only the lists named in lists are decoded into records, the elements of the others are read and dropped
+def iter_authorization_details(path, lists=None):
+    with open(path) as f:
+        stream = JsonStream(f)
+        stream.expect('{')
+        while stream.peek() not in ['}', '']:
+            key = stream.value()
+            stream.expect(':')
+            if key in detail_lists and stream.peek() == '[':
+                stream.expect('[')
+                while stream.peek() not in [']', '']:
+                    record = stream.value()
+                    if lists is None or key in lists:
+                        yield key, record
+                    if stream.peek() == ',':
+                        stream.expect(',')
+                stream.expect(']')
+            else:
+                stream.value() # IsTruncated, Marker and the like
+            if stream.peek() == ',':
+                stream.expect(',')
+        stream.expect('}')
+
+# Whether a JSON file is an authorization details dump, from its top-level keys up to the first detail list
+def is_authorization_details(path):
+    with open(path) as f:
+        stream = JsonStream(f)
+        if stream.peek() != '{':
+            return False
+        stream.expect('{')
+        while stream.peek() not in ['}', '']:
+            if stream.value() in detail_lists:
+                return True
+            stream.expect(':')
+            stream.value()
+            if stream.peek() == ',':
+                stream.expect(',')
+    return False
+
+# State of a parse worker process, set once by init_parse_worker
+parse_worker = {}
+
+def init_parse_worker(groups, documents, inventory):
+    parse_worker['groups'] = groups
+    parse_worker['documents'] = documents
+    parse_worker['inventory'] = inventory
+    parse_worker['table'] = MethodTable(escalation_methods, all_perms)
+
+# Parse and evaluate a batch of user records in a parse worker, returning only what the results need and how many findings the
+# worker's copy of the inventory upgraded and dropped in the batch
+def parse_user_batch(details):
+    inventory = parse_worker['inventory']
+    counts = (inventory.upgraded, inventory.dropped) if inventory is not None else (0, 0)
+    users = [user_from_details(detail, parse_worker['groups'], parse_worker['documents']) for detail in details]
+    evaluate_principals(users, parse_worker['table'], inventory)
+    if inventory is not None:
+        counts = (inventory.upgraded - counts[0], inventory.dropped - counts[1])
+    return [{'UserName': user['UserName'], 'CheckedMethods': user['CheckedMethods']} for user in users], counts
+
+# Parse and evaluate the users of a large authorization details dump in worker processes, returning how many there were
+def stream_snapshot(path, stream, workers, user_names=None, inventory=None, batch_size=500):
+    documents = {}
+    group_details = []
+    for key, record in iter_authorization_details(path, ['GroupDetailList', 'Policies']):
+        if key == 'Policies':
+            documents.update(managed_policy_documents({'Policies': [record]}))
+        else:
+            group_details.append(record)
+    groups = groups_from_authorization_details({'GroupDetailList': group_details}, documents)
+    print('  Parsed {} groups and {} managed policies, streaming the users to {} workers...'.format(len(groups), len(documents), workers))
+    count = 0
+    running = set()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_parse_worker, initargs=(groups, documents, inventory)) as executor:
+        batch = []
+        for key, detail in iter_authorization_details(path, ['UserDetailList']):
+            if user_names is not None and detail['UserName'] not in user_names:
+                continue
+            batch.append(detail)
+            if len(batch) < batch_size:
+                continue
+            running.add(executor.submit(parse_user_batch, batch))
+            batch = []
+            if len(running) >= workers * 2:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    count += merge_parsed_batch(future.result(), stream, inventory)
+        if batch != []:
+            running.add(executor.submit(parse_user_batch, batch))
+        for future in as_completed(running):
+            count += merge_parsed_batch(future.result(), stream, inventory)
+    return count
+
+# Write the results of a parse worker's batch and add its inventory counts to the main process' inventory
+def merge_parsed_batch(result, stream, inventory):
+    users, (upgraded, dropped) = result
+    stream.write(users)
+    if inventory is not None:
+        inventory.upgraded += upgraded
+        inventory.dropped += dropped
+    return len(users)
+
+# Merge an already parsed Allow/Deny map (e.g. a cached group) into a principal that is still being collected. Resources
+# are copied into the principal's own sets so the source is never modified
+def merge_permissions(principal, source):
+    for effect in ['Allow', 'Deny']:
+        permissions = principal['Permissions'][effect]
+        for action, resources in source['Permissions'][effect].items():
+            add_resources(permissions, action, resources)
+    return principal
+
+# Compiled wildcard patterns shared by every matcher, keyed by the lowercased action string from the policy
+wildcard_patterns = {}
+
+def compile_wildcard(action):
+    pattern = wildcard_patterns.get(action)
+    if pattern is None:
+        regex = ''.join('.*' if char == '*' else '.' if char == '?' else re.escape(char) for char in action)
+        pattern = re.compile('^{}$'.format(regex))
+        wildcard_patterns[action] = pattern
+    return pattern
+
+# Matches target actions against the keys of one Allow or Deny map, case-insensitively, with wildcards indexed by service
+class ActionMatcher(object):
+    def __init__(self, permissions):
+        self.permissions = permissions
+        self.exact = {} # lowercased action -> policy keys
+        self.services = {} # lowercased service prefix -> [(pattern, policy key)]
+        self.any_service = [] # [(pattern, policy key)] for wildcards in the service prefix
+        for key in permissions:
+            action = key.lower()
+            if '*' not in action and '?' not in action:
+                self.exact.setdefault(action, []).append(key)
                 continue
-            for perm in all_perms:
-                for effect in ['Allow', 'Deny']:
-                    if perm in user['Permissions'][effect]:
-                        checked_perms[effect][perm] = user['Permissions'][effect][perm]
+            service = action.split(':', 1)[0]
+            if ':' not in action or '*' in service or '?' in service:
+                self.any_service.append((compile_wildcard(action), key))
+            else:
+                self.services.setdefault(service, []).append((compile_wildcard(action), key))
+
+    # Every policy key that covers this action
+    def matching_keys(self, action):
+        action = action.lower()
+        keys = list(self.exact.get(action, []))
+        for pattern, key in self.services.get(action.split(':', 1)[0], []) + self.any_service:
+            if pattern.match(action) is not None:
+                keys.append(key)
+        return keys
+
+    # The resources this action is granted (or denied) on, merged across every matching key, or None if no key matches
+    def match(self, action):
+        keys = self.matching_keys(action)
+        if keys == []:
+            return None
+        if len(keys) == 1:
+            return self.permissions[keys[0]]
+        resources = set()
+        for key in keys:
+            resources.update(self.permissions[key])
+        if '*' in resources:
+            return frozenset(['*'])
+        return frozenset(resources)
+
+    # {action: resources} for each target action that is matched
+    def match_all(self, actions):
+        matched = {}
+        for action in actions:
+            resources = self.match(action)
+            if resources is not None:
+                matched[action] = resources
+        return matched
+
+# Resolve which of the target actions a principal's Allow and Deny maps cover, and on which resources
+def check_permissions(permissions, actions):
+    return {
+        'Allow': ActionMatcher(permissions['Allow']).match_all(actions),
+        'Deny': ActionMatcher(permissions['Deny']).match_all(actions)
+    }
+
+# Allowed every action on every resource. Deny is not taken into account, so documents parsed after that cannot change it
+def is_admin(principal):
+    return '*' in principal['Permissions']['Allow'].get('*', ())
+
+# Whether the documents parsed so far already decide a principal's results, so lazy collection can skip the rest: it is an
+# admin, or each of perms is both allowed and denied on '*'. More documents only add grants, so neither can be undone, and
+# a permission that is only allowed can still be denied later
+def permissions_settled(principal, perms):
+    if is_admin(principal):
+        return True
+    deny = principal['Permissions']['Deny']
+    if not any('*' in resources for resources in deny.values()):
+        return False
+    allowed = ActionMatcher(principal['Permissions']['Allow']).match_all(perms)
+    denied = ActionMatcher(deny).match_all(perms)
+    return all('*' in allowed.get(perm, ()) and '*' in denied.get(perm, ()) for perm in perms)
+
+# The escalation method table compiled into bit masks over the Allowed, Denied and Allowed-on-'*' permission vectors
+class MethodTable(object):
+    def __init__(self, methods, perms=None):
+        self.methods = list(methods)
+        self.perms = list(perms or [])
+        for method in self.methods:
+            for perm in methods[method]:
+                if perm not in self.perms:
+                    self.perms.append(perm)
+        self.requires = dict((method, list(methods[method])) for method in self.methods)
+        self.bits = dict((perm, 1 << index) for index, perm in enumerate(self.perms))
+        self.masks = [sum(self.bits[perm] for perm in methods[method]) for method in self.methods]
+        self.words = (len(self.perms) + 63) // 64
+
+    # (allow, deny, full) bit vectors of a check_permissions() result, as Python ints
+    def encode(self, checked_perms):
+        allow = deny = full = 0
+        for perm, resources in checked_perms['Allow'].items():
+            allow |= self.bits.get(perm, 0)
+            if '*' in resources:
+                full |= self.bits.get(perm, 0)
+        for perm in checked_perms['Deny']:
+            deny |= self.bits.get(perm, 0)
+        return (allow, deny, full)
+
+    # {'Potential': [...], 'Confirmed': [...]} for each encoded principal, in method table order
+    def evaluate(self, encoded):
+        if numpy is not None and len(encoded) >= 32: # Below that, setting up the arrays costs more than it saves
+            return self.evaluate_numpy(encoded)
+        return self.evaluate_python(encoded)
+
+    def evaluate_python(self, encoded):
+        results = []
+        for allow, deny, full in encoded:
+            checked_methods = {'Potential': [], 'Confirmed': []}
+            for method, mask in zip(self.methods, self.masks):
+                if allow & mask == mask:
+                    if full & mask == mask and deny & mask == 0:
+                        checked_methods['Confirmed'].append(method)
                     else:
-                        for user_perm in user['Permissions'][effect].keys():
-                            if '*' in user_perm:
-                                pattern = re.compile(user_perm.replace('*', '.*'))
-                                if pattern.search(perm) is not None:
-                                    checked_perms[effect][perm] = user['Permissions'][effect][user_perm]
-
-        checked_methods = {
-            'Potential': [],
-            'Confirmed': []
+                        checked_methods['Potential'].append(method)
+            results.append(checked_methods)
+        return results
+
+    # Split Python int bit vectors into an (n, words) uint64 matrix
+    def to_words(self, values):
+        if self.words == 1:
+            return numpy.array(values, dtype=numpy.uint64).reshape(len(values), 1)
+        matrix = numpy.zeros((len(values), self.words), dtype=numpy.uint64)
+        for word in range(self.words):
+            matrix[:, word] = [(value >> (64 * word)) & 0xFFFFFFFFFFFFFFFF for value in values]
+        return matrix
+
+    def evaluate_numpy(self, encoded):
+        allow, deny, full = [self.to_words(list(values))[:, None, :] for values in zip(*encoded)]
+        masks = self.to_words(self.masks)[None, :, :]
+        allowed = ((allow & masks) == masks).all(axis=2)
+        confirmed = allowed & ((full & masks) == masks).all(axis=2) & ((deny & masks) == 0).all(axis=2)
+        # Only the hits are turned back into Python objects, nonzero() keeps them in principal then method order
+        results = [{'Potential': [], 'Confirmed': []} for _ in encoded]
+        for status, matrix in [('Confirmed', confirmed), ('Potential', allowed & ~confirmed)]:
+            rows, columns = numpy.nonzero(matrix)
+            for row, column in zip(rows.tolist(), columns.tolist()):
+                results[row][status].append(self.methods[column])
+        return results
+
+# The kind of resource each checked permission acts on, for the permissions whose targets can be looked up in an inventory
+perm_targets = {
+    'iam:AddUserToGroup': 'group',
+    'iam:AttachGroupPolicy': 'group',
+    'iam:AttachRolePolicy': 'role',
+    'iam:AttachUserPolicy': 'user',
+    'iam:CreateAccessKey': 'user',
+    'iam:CreatePolicyVersion': 'policy',
+    'iam:CreateLoginProfile': 'user',
+    'iam:PassRole': 'role',
+    'iam:PutGroupPolicy': 'group',
+    'iam:PutRolePolicy': 'role',
+    'iam:PutUserPolicy': 'user',
+    'iam:SetDefaultPolicyVersion': 'policy',
+    'iam:UpdateAssumeRolePolicy': 'role',
+    'iam:UpdateLoginProfile': 'user',
+    'sts:AssumeRole': 'role'
+}
+
+# An ARN or ARN pattern split into segments, each keeping the ':' or '/' that ends it
+def arn_tokens(arn):
+    return re.findall('[^:/]*[:/]|[^:/]+$', arn)
+
+# Resource patterns from a policy indexed by ARN segment, with wildcard tails compiled at the node where they start
+class ResourceTrie(object):
+    def __init__(self, patterns=()):
+        self.root = {'children': {}, 'tails': [], 'end': False}
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        node = self.root
+        tokens = arn_tokens(pattern)
+        for index, token in enumerate(tokens):
+            if '*' in token or '?' in token:
+                node['tails'].append(compile_wildcard(''.join(tokens[index:])))
+                return
+            node = node['children'].setdefault(token, {'children': {}, 'tails': [], 'end': False})
+        node['end'] = True
+
+    def matches(self, arn):
+        node = self.root
+        position = 0
+        for token in arn_tokens(arn):
+            if node['tails'] != [] and any(tail.match(arn[position:]) is not None for tail in node['tails']):
+                return True
+            node = node['children'].get(token)
+            if node is None:
+                return False
+            position += len(token)
+        return node['end'] or any(tail.match('') is not None for tail in node['tails'])
+
+# The users, groups, roles and managed policies known to exist in the account, from --inventory. Only the kinds of resource
+# the inventory holds are used: a ListRoles dump such as all-roles.json only says which roles exist
+class ResourceInventory(object):
+    def __init__(self, details):
+        self.arns = {
+            'user': [user['Arn'] for user in details.get('UserDetailList', []) if 'Arn' in user],
+            'group': [group['Arn'] for group in details.get('GroupDetailList', []) if 'Arn' in group],
+            'role': [role['Arn'] for role in details.get('RoleDetailList', []) if 'Arn' in role],
+            'policy': [policy['Arn'] for policy in details.get('Policies', []) if 'Arn' in policy]
         }
+        self.digest = hashlib.sha1(json.dumps(self.arns, sort_keys=True).encode()).hexdigest()
+        self.upgraded = 0
+        self.dropped = 0
 
-        # Ditch each escalation method that has been confirmed not to be possible
-        for method in escalation_methods:
-            potential = True
-            confirmed = True
-            for perm in escalation_methods[method]:
-                if perm not in checked_perms['Allow']: # If this permission isn't Allowed, then this method won't work
-                    potential = confirmed = False
+    def summary(self):
+        names = {'user': 'users', 'group': 'groups', 'role': 'roles', 'policy': 'managed policies'}
+        return ', '.join('{} {}'.format(len(arns), names[kind]) for kind, arns in self.arns.items() if arns != [])
+
+    # The inventoried resources of one kind a permission is allowed on and not denied on, stopping after limit matches
+    def targets(self, kind, allow, deny, limit=None):
+        found = []
+        for arn in self.arns[kind]:
+            if allow.matches(arn) and not deny.matches(arn):
+                found.append(arn)
+                if limit is not None and len(found) >= limit:
                     break
-                elif perm in checked_perms['Deny'] and perm in checked_perms['Allow']: # Permission is both Denied and Allowed, leave as potential, not confirmed
-                    confirmed = False
-                elif perm in checked_perms['Allow'] and perm not in checked_perms['Deny']: # It is Allowed and not Denied
-                    if not checked_perms['Allow'][perm] == ['*']:
-                        confirmed = False
-            if confirmed is True:
-                print('  CONFIRMED: {}\n'.format(method))
-                checked_methods['Confirmed'].append(method)
-            elif potential is True:
-                print('  POTENTIAL: {}\n'.format(method))
-                checked_methods['Potential'].append(method)
-        user['CheckedMethods'] = checked_methods
-        if checked_methods['Potential'] == [] and checked_methods['Confirmed'] == []:
-            print('  No methods possible.\n')
+        return found
 
-    now = time.time()
-    headers = 'CreateNewPolicyVersion,SetExistingDefaultPolicyVersion,CreateEC2WithExistingIP,CreateAccessKey,CreateLoginProfile,UpdateLoginProfile,AttachUserPolicy,AttachGroupPolicy,AttachRolePolicy,PutUserPolicy,PutGroupPolicy,PutRolePolicy,AddUserToGroup,UpdateRolePolicyToAssumeIt,PassExistingRoleToNewLambdaThenInvoke,PassExistingRoleToNewLambdaThenTriggerWithNewDynamo,PassExistingRoleToNewLambdaThenTriggerWithExistingDynamo,PassExistingRoleToNewGlueDevEndpoint,UpdateExistingGlueDevEndpoint,PassExistingRoleToCloudFormation,PassExistingRoleToNewDataPipeline,EditExistingLambdaFunctionWithRole'
-    file = open('all_user_privesc_scan_results_{}.csv'.format(now), 'w+')
-    for user in users:
-        if 'admin' in user['CheckedMethods']:
-            file.write(',{} (Admin)'.format(user['UserName']))
+    # Re-rate a principal's methods against the resources that exist. A permission acting on an inventoried kind of resource
+    # counts when it is allowed and not denied on at least one of them: a method with such a permission that applies to
+    # nothing is dropped, and a Potential method is upgraded to Confirmed when its inventoried permissions apply to something
+    # and the rest are allowed on '*' and not denied. Permissions granted only through NotResource have no resource list
+    # to check and leave the method as it was
+    def refine(self, principal, checked_perms, checked_methods, table):
+        name = principal.get('UserName') or principal.get('RoleName') or ''
+        applies = {}
+        for perm, resources in checked_perms['Allow'].items():
+            kind = perm_targets.get(perm)
+            if kind is None or self.arns[kind] == [] or len(resources) == 0:
+                continue
+            allow = ResourceTrie(resource.replace('${aws:username}', name) for resource in resources)
+            deny = ResourceTrie(resource.replace('${aws:username}', name) for resource in checked_perms['Deny'].get(perm, []))
+            applies[perm] = self.targets(kind, allow, deny, 1) != []
+        refined = {'Potential': [], 'Confirmed': []}
+        for method in table.methods:
+            status = 'Confirmed' if method in checked_methods['Confirmed'] else 'Potential' if method in checked_methods['Potential'] else None
+            if status is None:
+                continue
+            perms = table.requires[method]
+            if any(applies.get(perm) is False for perm in perms):
+                self.dropped += 1
+                continue
+            if status == 'Potential' and any(perm in applies for perm in perms) and all(
+                applies.get(perm) is True or ('*' in checked_perms['Allow'][perm] and perm not in checked_perms['Deny'])
+                for perm in perms
+            ):
+                status = 'Confirmed'
+                self.upgraded += 1
+            refined[status].append(method)
+        return refined
+
+# How each escalation method links the principal that has it to other principals in the escalation graph:
+#   ('admin',) - the principal can give itself (or anyone) admin permissions directly
+#   ('user', perm) - the principal can log in as the users that perm is allowed on
+#   ('role', perm, service) - the principal can get code running as a role trusted by that service, limited to the roles
+#                             that perm is allowed on (perm is None when the role comes with an existing resource)
+method_edges = {
+    'CreateNewPolicyVersion': ('admin',),
+    'SetExistingDefaultPolicyVersion': ('admin',),
+    'CreateEC2WithExistingIP': ('role', 'iam:PassRole', 'ec2.amazonaws.com'),
+    'CreateAccessKey': ('user', 'iam:CreateAccessKey'),
+    'CreateLoginProfile': ('user', 'iam:CreateLoginProfile'),
+    'UpdateLoginProfile': ('user', 'iam:UpdateLoginProfile'),
+    'AttachUserPolicy': ('admin',),
+    'AttachGroupPolicy': ('admin',),
+    'AttachRolePolicy': ('admin',),
+    'PutUserPolicy': ('admin',),
+    'PutGroupPolicy': ('admin',),
+    'PutRolePolicy': ('admin',),
+    'AddUserToGroup': ('admin',),
+    'UpdateRolePolicyToAssumeIt': ('admin',),
+    'PassExistingRoleToNewLambdaThenInvoke': ('role', 'iam:PassRole', 'lambda.amazonaws.com'),
+    'PassExistingRoleToNewLambdaThenTriggerWithNewDynamo': ('role', 'iam:PassRole', 'lambda.amazonaws.com'),
+    'PassExistingRoleToNewLambdaThenTriggerWithExistingDynamo': ('role', 'iam:PassRole', 'lambda.amazonaws.com'),
+    'PassExistingRoleToNewGlueDevEndpoint': ('role', 'iam:PassRole', 'glue.amazonaws.com'),
+    'UpdateExistingGlueDevEndpoint': ('role', None, 'glue.amazonaws.com'),
+    'PassExistingRoleToCloudFormation': ('role', 'iam:PassRole', 'cloudformation.amazonaws.com'),
+    'PassExistingRoleToNewDataPipeline': ('role', 'iam:PassRole', 'datapipeline.amazonaws.com'),
+    'EditExistingLambdaFunctionWithRole': ('role', None, 'lambda.amazonaws.com')
+}
+
+# Principals are identified by ARN in the escalation graph, falling back to their name when the ARN is unknown
+def principal_id(principal):
+    if principal.get('Arn') is not None:
+        return principal['Arn']
+    if 'RoleName' in principal:
+        return 'role/{}'.format(principal['RoleName'])
+    return 'user/{}'.format(principal['UserName'])
+
+def arn_account(arn):
+    parts = (arn or '').split(':')
+    if len(parts) >= 6 and parts[0] == 'arn':
+        return parts[4]
+    return None
+
+# Whether any of the resource patterns from a policy covers this ARN. An unknown ARN is only covered by '*'
+def resource_matches(resources, arn):
+    if arn is None:
+        return '*' in resources
+    return any(compile_wildcard(resource).match(arn) is not None for resource in resources)
+
+# The action each type of trusted principal assumes a role with. Federated principals use web identity (OIDC) or SAML
+trust_actions = {
+    'AWS': ['sts:assumerole'],
+    'Service': ['sts:assumerole'],
+    'Federated': ['sts:assumerolewithwebidentity', 'sts:assumerolewithsaml']
+}
+
+# The principals an Allow statement of a role's trust policy lets assume it, as (type, value, conditions) tuples. A statement
+# with NotPrincipal trusts everyone but the principals it lists, it is returned as trusting AWS '*'
+def trusted_principals(role):
+    document = role.get('AssumeRolePolicyDocument') or {'Statement': []}
+    statements = document['Statement'] if type(document['Statement']) is list else [document['Statement']]
+    for statement in statements:
+        if statement.get('Effect') != 'Allow' or ('Principal' not in statement and 'NotPrincipal' not in statement):
+            continue
+        actions = statement.get('Action', [])
+        if type(actions) is not list:
+            actions = [actions]
+        principals = statement.get('Principal', '*')
+        if principals == '*':
+            principals = {'AWS': '*'}
+        for principal_type, values in principals.items():
+            if not any(compile_wildcard(action.lower()).match(trust_action) is not None for action in actions for trust_action in trust_actions.get(principal_type, [])):
+                continue
+            for value in values if type(values) is list else [values]:
+                yield principal_type, value, statement.get('Condition', {})
+
+# The host an OIDC provider is known by in condition keys, e.g. token.actions.githubusercontent.com for
+# arn:aws:iam::123456789012:oidc-provider/token.actions.githubusercontent.com. Other providers are kept as they are
+def federated_provider(value):
+    if ':oidc-provider/' in value:
+        return value.split(':oidc-provider/', 1)[1]
+    return value
+
+# The subjects a trust statement's conditions allow for a federated provider, as (value, wildcard) tuples: StringEquals values
+# are exact and StringLike values are patterns. ('*', True) when neither restricts the subject; other operators on it, such
+# as StringNotLike, do not name who may assume the role. SAML providers use the SAML:sub key
+def subject_patterns(provider, conditions):
+    key = 'saml:sub' if ':saml-provider/' in provider else '{}:sub'.format(provider).lower()
+    patterns = []
+    for operator, values in conditions.items():
+        name = operator.split(':')[-1].replace('IfExists', '')
+        if name not in ['StringEquals', 'StringLike']:
+            continue
+        for condition_key, condition_values in values.items():
+            if condition_key.lower() != key:
+                continue
+            for value in condition_values if type(condition_values) is list else [condition_values]:
+                patterns.append((value, name == 'StringLike' and ('*' in value or '?' in value)))
+    return patterns or [('*', True)]
+
+# Whether a subject pattern leaves the identity itself open. Subjects are ':'-separated with the identity first, e.g.
+# repo:OWNER/REPO:ref:refs/heads/main for GitHub Actions, so a wildcard in the first two fields lets in other repositories
+def broad_subject(pattern):
+    return any('*' in field or '?' in field for field in pattern.split(':')[:2])
+
+# Lookups from trusted principals (ARN, account, service, federated provider and subject) to the roles that trust them
+class TrustIndex(object):
+    def __init__(self, roles):
+        self.roles = roles
+        self.by_arn = {}
+        self.by_account = {}
+        self.by_service = {}
+        self.by_subject = {} # provider -> {'exact': {subject: entries}, 'patterns': {pattern: entries}}
+        self.findings = []
+        for role in roles:
+            for principal_type, value, conditions in trusted_principals(role):
+                self.add(role, principal_type, value, conditions)
+
+    def add(self, role, principal_type, value, conditions):
+        entry = (role, conditions == {})
+        if principal_type == 'Service':
+            self.by_service.setdefault(value, []).append(entry)
+        elif principal_type == 'AWS':
+            if value == '*':
+                self.by_account.setdefault('*', []).append(entry)
+                self.flag(role, 'AWS', value, 'Any AWS principal can assume the role', conditions)
+            elif value.isdigit() or value.endswith(':root'):
+                account = value if value.isdigit() else arn_account(value)
+                self.by_account.setdefault(account, []).append(entry)
+            else:
+                self.by_arn.setdefault(value, []).append(entry)
+        elif principal_type == 'Federated':
+            provider = federated_provider(value)
+            subjects = self.by_subject.setdefault(provider, {'exact': {}, 'patterns': {}})
+            for pattern, wildcard in subject_patterns(provider, conditions):
+                if not wildcard:
+                    subjects['exact'].setdefault(pattern, []).append(entry)
+                    continue
+                subjects['patterns'].setdefault(pattern, []).append(entry)
+                if pattern == '*':
+                    if ':saml-provider/' not in provider: # SAML roles are picked by the identity provider's assertion
+                        self.flag(role, 'Federated', provider, 'Any identity from the provider can assume the role', conditions)
+                elif broad_subject(pattern):
+                    self.flag(role, 'Federated', provider, 'Wildcard in the subject identity {}'.format(pattern), conditions)
+
+    def flag(self, role, principal_type, value, issue, conditions):
+        self.findings.append({
+            'Role': principal_id(role),
+            'Principal': '{}:{}'.format(principal_type, value),
+            'Issue': issue,
+            'Conditional': conditions != {}
+        })
+
+    # Roles a user or role can assume with sts:AssumeRole, given the resources its identity policies allow and deny the action
+    # on (from check_permissions). A trust policy naming the principal's ARN is enough on its own within the account, one that
+    # trusts its whole account or any AWS principal also needs the identity policy to allow the role
+    def assumable(self, principal, allow=None, deny=()):
+        source = principal_id(principal)
+        results = []
+        for role, unconditional in self.by_arn.get(source, []):
+            if not resource_matches(deny, role.get('Arn')):
+                results.append({'Role': principal_id(role), 'Via': source, 'Confirmed': unconditional})
+        if allow is None:
+            return results
+        for account in [arn_account(source), '*']:
+            for role, unconditional in self.by_account.get(account, []):
+                if resource_matches(allow, role.get('Arn')) and not resource_matches(deny, role.get('Arn')):
+                    results.append({'Role': principal_id(role), 'Via': account, 'Confirmed': unconditional and '*' in allow})
+        return results
+
+    # Roles an OIDC or SAML identity can assume, with the subject claim of its token when it has one
+    def federated(self, provider, subject=None):
+        subjects = self.by_subject.get(federated_provider(provider), {'exact': {}, 'patterns': {}})
+        entries = list(subjects['exact'].get(subject, [])) if subject is not None else []
+        for pattern, pattern_entries in subjects['patterns'].items():
+            if pattern == '*' or (subject is not None and compile_wildcard(pattern).match(subject) is not None):
+                entries += pattern_entries
+        return entries
+
+    # For each federated provider, the roles an identity with each subject or subject pattern named in a trust policy can assume
+    def federated_roles(self):
+        reachable = {}
+        for provider, subjects in self.by_subject.items():
+            reachable[provider] = {}
+            for subject in list(subjects['exact']) + list(subjects['patterns']):
+                roles = [principal_id(role) for role, unconditional in self.federated(provider, subject)]
+                reachable[provider][subject] = sorted(set(roles))
+        return reachable
+
+    def summary(self):
+        return '{} roles trusting {} principals, {} accounts, {} services and {} federated providers, {} broad trusts'.format(
+            len(self.roles),
+            len(self.by_arn),
+            len(self.by_account),
+            len(self.by_service),
+            len(self.by_subject),
+            len(self.findings)
+        )
+
+# Graph of principals where an edge means "can act as", with virtual '#' nodes for edges to every user or trusted role
+class EscalationGraph(object):
+    admin = '#admin'
+
+    def __init__(self, users, roles, table):
+        self.principals = {}
+        self.edges = {} # node -> [(target, weight, method, confirmed)], weight 0 for edges out of virtual nodes
+        self.admins = set([self.admin])
+        self.distance = {}
+        self.next_hop = {}
+        for principal in users + roles:
+            self.principals.setdefault(principal_id(principal), principal)
+        self.users = users
+        self.roles = roles
+        self.trust = TrustIndex(roles)
+        candidates = []
+        for principal in self.principals.values():
+            if is_admin(principal):
+                self.admins.add(principal_id(principal))
+            else:
+                candidates.append(principal)
+        checked = [check_permissions(principal['Permissions'], table.perms) for principal in candidates]
+        methods = table.evaluate([table.encode(checked_perms) for checked_perms in checked])
+        for principal, checked_perms, checked_methods in zip(candidates, checked, methods):
+            self.add_assume_role_edges(principal, checked_perms)
+            self.add_method_edges(principal, checked_perms, checked_methods)
+
+    def add_edge(self, source, target, weight, method, confirmed):
+        if source != target:
+            self.edges.setdefault(source, []).append((target, weight, method, confirmed))
+
+    def add_assume_role_edges(self, principal, checked_perms):
+        source = principal_id(principal)
+        allow = checked_perms['Allow'].get('sts:AssumeRole')
+        deny = checked_perms['Deny'].get('sts:AssumeRole', [])
+        # A trust policy that names the principal itself is enough on its own within the account
+        for role, unconditional in self.trust.by_arn.get(source, []):
+            if not resource_matches(deny, role.get('Arn')):
+                self.add_edge(source, principal_id(role), 1, 'AssumeRole', unconditional)
+        if allow is None:
+            return
+        for account in [arn_account(source), '*']:
+            roles = self.trust.by_account.get(account, [])
+            if roles == []:
+                continue
+            if '*' in allow and len(deny) == 0:
+                virtual = '#trusts-account:{}'.format(account)
+                if virtual not in self.edges:
+                    for role, unconditional in roles:
+                        self.add_edge(virtual, principal_id(role), 0, 'AssumeRole', unconditional)
+                self.add_edge(source, virtual, 1, 'AssumeRole', True)
+            else:
+                for role, unconditional in roles:
+                    if resource_matches(allow, role.get('Arn')) and not resource_matches(deny, role.get('Arn')):
+                        self.add_edge(source, principal_id(role), 1, 'AssumeRole', unconditional and '*' in allow)
+
+    def add_method_edges(self, principal, checked_perms, checked_methods):
+        source = principal_id(principal)
+        for status in ['Confirmed', 'Potential']:
+            for method in checked_methods[status]:
+                edge = method_edges.get(method)
+                if edge is None:
+                    continue
+                if edge[0] == 'admin':
+                    self.add_edge(source, self.admin, 1, method, status == 'Confirmed')
+                    continue
+                if edge[0] == 'user':
+                    virtual = '#users'
+                    targets = [(user, True) for user in self.users]
+                else:
+                    virtual = '#trusts-service:{}'.format(edge[2])
+                    targets = self.trust.by_service.get(edge[2], [])
+                resources = checked_perms['Allow'].get(edge[1], ['*']) if edge[1] is not None else ['*']
+                if '*' in resources:
+                    if virtual not in self.edges:
+                        for target, unconditional in targets:
+                            self.add_edge(virtual, principal_id(target), 0, method, unconditional)
+                    self.add_edge(source, virtual, 1, method, status == 'Confirmed')
+                else:
+                    for target, unconditional in targets:
+                        if resource_matches(resources, target.get('Arn')):
+                            self.add_edge(source, principal_id(target), 1, method, status == 'Confirmed' and unconditional)
+
+    # Shortest path to admin for every node, up to max_depth hops, with a 0-1 breadth-first search over the reversed edges
+    def solve(self, max_depth=5):
+        reverse = {}
+        for source, edges in self.edges.items():
+            for target, weight, method, confirmed in edges:
+                reverse.setdefault(target, []).append((source, weight, method, confirmed))
+        self.distance = dict((admin, 0) for admin in self.admins)
+        self.next_hop = {}
+        queue = deque(self.admins)
+        while queue:
+            node = queue.popleft()
+            for source, weight, method, confirmed in reverse.get(node, []):
+                distance = self.distance[node] + weight
+                if distance > max_depth or distance >= self.distance.get(source, max_depth + 1):
+                    continue
+                self.distance[source] = distance
+                self.next_hop[source] = (node, method, confirmed)
+                if weight == 0:
+                    queue.appendleft(source)
+                else:
+                    queue.append(source)
+        return self
+
+    # Steps from a principal to admin, [] if it is an admin already and None if admin is not reachable
+    def path(self, principal):
+        node = principal_id(principal)
+        if node not in self.distance:
+            return None
+        steps = []
+        while node not in self.admins:
+            target, method, confirmed = self.next_hop[node]
+            if node.startswith('#'): # Hop out of a virtual node, it only stands for the real target
+                steps[-1]['To'] = target
+                steps[-1]['Confirmed'] = steps[-1]['Confirmed'] and confirmed
+            else:
+                steps.append({'From': node, 'To': target, 'Method': method, 'Confirmed': confirmed})
+            node = target
+        return steps
+
+def format_path(steps):
+    names = [steps[0]['From'].split('/')[-1]]
+    for step in steps:
+        names.append('-[{}{}]-> {}'.format(step['Method'], '' if step['Confirmed'] else '?', 'admin' if step['To'] == EscalationGraph.admin else step['To'].split('/')[-1]))
+    return ' '.join(names)
+
+# Inverted index from actions to the users and roles allowed them, for answering queries against one collection
+class PermissionIndex(object):
+    def __init__(self, principals, table):
+        self.lock = threading.Lock()
+        self.table = table
+        self.principals = {} # principal_id -> principal
+        self.matchers = {} # principal_id -> (Allow ActionMatcher, Deny ActionMatcher)
+        self.names = {} # UserName or RoleName -> principal_id
+        self.exact = {} # lowercased action -> principal_ids
+        self.services = {} # lowercased service prefix -> {lowercased wildcard action -> principal_ids}
+        self.any_service = {} # lowercased wildcard action with a wildcard in the service prefix -> principal_ids
+        for principal in principals:
+            self.update(principal)
+
+    # The set of principals a policy action key is filed under
+    def entry(self, key):
+        action = key.lower()
+        if '*' not in action and '?' not in action:
+            return self.exact.setdefault(action, set())
+        service = action.split(':', 1)[0]
+        if ':' not in action or '*' in service or '?' in service:
+            return self.any_service.setdefault(action, set())
+        return self.services.setdefault(service, {}).setdefault(action, set())
+
+    def resolve(self, name):
+        return name if name in self.principals else self.names.get(name)
+
+    # Add a principal, or replace the one with the same ID, and evaluate its escalation methods
+    def update(self, principal):
+        if is_admin(principal):
+            principal['CheckedMethods'] = {'admin': {}, 'Confirmed': {}, 'Potential': {}}
         else:
-            file.write(',{}'.format(user['UserName']))
-    file.write('\n')
-    for method in headers.split(','):
-        file.write('{},'.format(method))
-        for user in users:
-            if method in user['CheckedMethods']['Confirmed']:
-                file.write('Confirmed,')
-            elif method in user['CheckedMethods']['Potential']:
-                file.write('Potential,')
+            checked_perms = check_permissions(principal['Permissions'], self.table.perms)
+            principal['CheckedMethods'] = self.table.evaluate_python([self.table.encode(checked_perms)])[0]
+        with self.lock:
+            node = principal_id(principal)
+            self.discard(node)
+            self.principals[node] = principal
+            self.matchers[node] = (ActionMatcher(principal['Permissions']['Allow']), ActionMatcher(principal['Permissions']['Deny']))
+            self.names[principal.get('UserName') or principal.get('RoleName')] = node
+            for key in principal['Permissions']['Allow']:
+                self.entry(key).add(node)
+        return principal
+
+    def remove(self, name):
+        with self.lock:
+            node = self.resolve(name)
+            if node is not None:
+                self.discard(node)
+            return node is not None
+
+    # Drop a principal from every entry it is filed under, the caller holds the lock
+    def discard(self, node):
+        principal = self.principals.pop(node, None)
+        if principal is None:
+            return
+        self.matchers.pop(node, None)
+        self.names.pop(principal.get('UserName') or principal.get('RoleName'), None)
+        for key in principal['Permissions']['Allow']:
+            self.entry(key).discard(node)
+
+    # Principals with an Allow key covering the action, before Deny is taken into account. The caller holds the lock
+    def candidates(self, action):
+        action = action.lower()
+        found = set(self.exact.get(action, ()))
+        for pattern, nodes in list(self.services.get(action.split(':', 1)[0], {}).items()) + list(self.any_service.items()):
+            if nodes and compile_wildcard(pattern).match(action) is not None:
+                found.update(nodes)
+        return found
+
+    # (principal, Allow matcher, Deny matcher) for the principals with Allow keys covering every one of actions, in ID order
+    def covering(self, actions):
+        with self.lock:
+            nodes = None
+            for action in actions:
+                found = self.candidates(action)
+                nodes = found if nodes is None else nodes & found
+                if nodes == set():
+                    break
+            return [(self.principals[node],) + self.matchers[node] for node in sorted(nodes or ())]
+
+    # Principals allowed every one of actions (on resource, when given) and not denied them on every resource. Confirmed when
+    # all of them are allowed on '*' and none is denied at all
+    def who_can(self, actions, resource=None):
+        actions = list(dict.fromkeys(actions))
+        results = []
+        for principal, allow, deny in self.covering(actions):
+            checked_perms = {'Allow': allow.match_all(actions), 'Deny': deny.match_all(actions)}
+            if len(checked_perms['Allow']) < len(actions):
+                continue
+            if any('*' in checked_perms['Deny'].get(action, ()) for action in actions):
+                continue
+            if resource is not None and not all(
+                resource_matches(checked_perms['Allow'][action], resource) and not resource_matches(checked_perms['Deny'].get(action, []), resource)
+                for action in actions
+            ):
+                continue
+            results.append({
+                'Principal': principal_id(principal),
+                'Confirmed': checked_perms['Deny'] == {} and all('*' in resources for resources in checked_perms['Allow'].values()),
+                'Allow': checked_perms['Allow'],
+                'Deny': checked_perms['Deny']
+            })
+        return results
+
+    # The escalation methods of one principal, None if it is not in the index
+    def methods(self, name):
+        with self.lock:
+            node = self.resolve(name)
+            principal = self.principals.get(node)
+        if principal is None:
+            return None
+        checked_methods = principal['CheckedMethods']
+        return {
+            'Principal': node,
+            'Admin': 'admin' in checked_methods,
+            'Confirmed': list(checked_methods['Confirmed']),
+            'Potential': list(checked_methods['Potential'])
+        }
+
+    # The principals an escalation method applies to, found through the index entries of the method's permissions
+    def who_has(self, method):
+        results = {'Confirmed': [], 'Potential': []}
+        for principal, allow, deny in self.covering(self.table.requires[method]):
+            for status in ['Confirmed', 'Potential']:
+                if method in principal['CheckedMethods'].get(status, ()):
+                    results[status].append(principal_id(principal))
+        return results
+
+    def summary(self):
+        with self.lock:
+            return {
+                'Principals': len(self.principals),
+                'ExactActions': len(self.exact),
+                'WildcardActions': len(self.any_service) + sum(len(patterns) for patterns in self.services.values())
+            }
+
+# Answer queries against a PermissionIndex over HTTP on localhost, as JSON. GET /who-can?action=...&action=...[&resource=ARN],
+# /methods?principal=NAME, /who-has?method=NAME and /stats; POST /refresh?principal=NAME collects one principal again with
+# refresh(name), which returns the new principal or None when it no longer exists
+class IndexRequestHandler(BaseHTTPRequestHandler):
+    index = None
+    refresh = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        start = time.perf_counter()
+        if url.path == '/who-can' and 'action' in query:
+            body = {'Principals': self.index.who_can(query['action'], query.get('resource', [None])[0])}
+        elif url.path == '/methods' and 'principal' in query:
+            body = self.index.methods(query['principal'][0])
+            if body is None:
+                return self.reply(404, {'Error': 'Unknown principal {}'.format(query['principal'][0])})
+        elif url.path == '/who-has' and 'method' in query:
+            if query['method'][0] not in self.index.table.requires:
+                return self.reply(404, {'Error': 'Unknown method {}'.format(query['method'][0])})
+            body = self.index.who_has(query['method'][0])
+        elif url.path == '/stats':
+            body = self.index.summary()
+        else:
+            return self.reply(400, {'Error': 'Unknown query {}'.format(self.path)})
+        body['Milliseconds'] = (time.perf_counter() - start) * 1000.0
+        self.reply(200, body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path != '/refresh' or 'principal' not in query:
+            return self.reply(400, {'Error': 'Unknown request {}'.format(self.path)})
+        name = query['principal'][0]
+        try:
+            principal = type(self).refresh(name)
+        except Exception as e:
+            return self.reply(500, {'Error': str(e)})
+        if principal is None:
+            if not self.index.remove(name):
+                return self.reply(404, {'Error': 'Unknown principal {}'.format(name)})
+            return self.reply(200, {'Principal': name, 'Removed': True})
+        self.index.update(principal)
+        self.reply(200, self.index.methods(principal_id(principal)))
+
+    def reply(self, status, body):
+        data = json.dumps(body, default=list).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+# Load the principals once, from --from-snapshot or the live API, and serve queries against them until interrupted. A refresh
+# reads the snapshot again, or collects the user from the API again with a fresh cache so changed policies are picked up
+def serve(args):
+    table = MethodTable(escalation_methods, all_perms)
+    if args.from_snapshot is not None:
+        print('Loading snapshot {}...'.format(args.from_snapshot))
+        details = load_snapshot(args.from_snapshot)
+        principals = users_from_authorization_details(details) + roles_from_authorization_details(details)
+
+        def refresh(name):
+            details = load_snapshot(args.from_snapshot)
+            details['UserDetailList'] = [user for user in details['UserDetailList'] if name in [user['UserName'], user.get('Arn')]]
+            details['RoleDetailList'] = [role for role in details['RoleDetailList'] if name in [role['RoleName'], role.get('Arn')]]
+            found = users_from_authorization_details(details) + roles_from_authorization_details(details)
+            return found[0] if found != [] else None
+    else:
+        client_factory = live_client_factory(args)
+        users, roles = collect_users(client_factory, args)
+        principals = users + roles
+
+        def refresh(name):
+            node = index.resolve(name)
+            if node is not None and 'RoleName' in index.principals[node]:
+                raise ValueError('Roles can only be refreshed from a snapshot')
+            user_name = name.split('/')[-1]
+            client = client_factory()
+            try:
+                client.get_user(UserName=user_name)
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'NoSuchEntity':
+                    return None
+                raise
+            user = collect_user_permissions(client, {'UserName': user_name, 'Permissions': {'Allow': {}, 'Deny': {}}}, PolicyCache())
+            if node is not None and 'Arn' in index.principals[node]:
+                user['Arn'] = index.principals[node]['Arn']
+            return user
+    start = time.perf_counter()
+    index = PermissionIndex(principals, table)
+    print('Indexed {} principals in {:.2f}s.'.format(len(principals), time.perf_counter() - start))
+    handler = type('Handler', (IndexRequestHandler,), {'index': index, 'refresh': staticmethod(refresh)})
+    server = ThreadingHTTPServer(('127.0.0.1', args.serve), handler)
+    print('Serving queries on http://127.0.0.1:{}/ (who-can, methods, who-has, stats, refresh), Ctrl+C to stop.'.format(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+# Fields of the long-format results, one record per principal, method and status
+result_fields = ['Principal', 'Method', 'Status']
+
+# Long-format records for one evaluated user. Admins get a single 'Admin' record and users with no possible methods a single
+# 'None' record, both with an empty method, so every scanned user appears in the results
+def result_records(user, table):
+    checked_methods = user['CheckedMethods']
+    if 'admin' in checked_methods:
+        yield {'Principal': user['UserName'], 'Method': '', 'Status': 'Admin'}
+        return
+    found = False
+    for method in table.methods:
+        for status in ['Confirmed', 'Potential']:
+            if method in checked_methods[status]:
+                found = True
+                yield {'Principal': user['UserName'], 'Method': method, 'Status': status}
+    if found is False:
+        yield {'Principal': user['UserName'], 'Method': '', 'Status': 'None'}
+
+def print_checked_methods(user, table):
+    print('User: {}'.format(user['UserName']))
+    checked_methods = user['CheckedMethods']
+    if 'admin' in checked_methods:
+        print('  Already an admin!\n')
+        return
+    for method in table.methods:
+        if method in checked_methods['Confirmed']:
+            print('  CONFIRMED: {}\n'.format(method))
+        elif method in checked_methods['Potential']:
+            print('  POTENTIAL: {}\n'.format(method))
+    if checked_methods['Potential'] == [] and checked_methods['Confirmed'] == []:
+        print('  No methods possible.\n')
+
+# Set the CheckedMethods of principals, evaluating all of them as one batch. With an inventory, findings are re-rated against
+# the resources that exist in the account
+def evaluate_principals(principals, table, inventory=None):
+    candidates = []
+    for principal in principals:
+        if is_admin(principal):
+            principal['CheckedMethods'] = {'admin': {}, 'Confirmed':{}, 'Potential': {}}
+        else:
+            candidates.append(principal)
+    checked = [check_permissions(principal['Permissions'], table.perms) for principal in candidates]
+    results = table.evaluate([table.encode(checked_perms) for checked_perms in checked])
+    for principal, checked_perms, checked_methods in zip(candidates, checked, results):
+        if inventory is not None:
+            checked_methods = inventory.refine(principal, checked_perms, checked_methods, table)
+        principal['CheckedMethods'] = checked_methods
+
+# Evaluates users as they are collected and streams their results to a JSONL or CSV file in long format
+class ResultStream(object):
+    def __init__(self, path, output_format, table, previous=None, batch_size=1, inventory=None, checkpoint=None):
+        self.path = path
+        self.output_format = output_format
+        self.table = table
+        self.previous = previous
+        self.inventory = inventory
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.pending = []
+        self.reused = 0
+        self.resumed = 0
+        self.file = open(path, 'w', newline='')
+        if output_format == 'csv':
+            self.writer = csv.DictWriter(self.file, fieldnames=result_fields)
+            self.writer.writeheader()
+
+    def add(self, user):
+        self.pending.append(user)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        with metrics.phase('scan'):
+            self.evaluate()
+        self.write(self.pending)
+        self.pending = []
+
+    # Write the results of users that are already evaluated
+    def write(self, users):
+        with metrics.phase('output'):
+            for user in users:
+                print_checked_methods(user, self.table)
+                for record in result_records(user, self.table):
+                    if self.output_format == 'csv':
+                        self.writer.writerow(record)
+                    else:
+                        self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+        if self.checkpoint is not None:
+            for user in users:
+                self.checkpoint.add(user)
+
+    def evaluate(self):
+        candidates = []
+        for user in self.pending:
+            previous = (self.previous or {}).get(user['UserName'])
+            if 'CheckedMethods' in user: # Evaluated by the run a checkpoint was resumed from
+                self.resumed += 1
+            elif previous is not None and user.get('Fingerprint') is not None and previous.get('Fingerprint') == user['Fingerprint']:
+                user['CheckedMethods'] = previous['CheckedMethods']
+                self.reused += 1
             else:
-                file.write(',')
+                candidates.append(user)
+        evaluate_principals(candidates, self.table, self.inventory)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+# Long-format records from a .jsonl or .csv results file
+def read_records(path):
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            for line in f:
+                if line.strip() != '':
+                    yield json.loads(line)
+
+# The legacy results layout: one column per user and one row per method. Rows follow escalation_methods, then any other
+# method found in the records, and columns follow principals when given, otherwise the order of the records
+def write_matrix(records_path, matrix_path, principals=None):
+    statuses = {}
+    order = []
+    methods = list(escalation_methods)
+    for record in read_records(records_path):
+        if record['Principal'] not in statuses:
+            statuses[record['Principal']] = {}
+            order.append(record['Principal'])
+        statuses[record['Principal']][record['Method']] = record['Status']
+        if record['Method'] != '' and record['Method'] not in methods:
+            methods.append(record['Method'])
+    if principals is None:
+        principals = order
+    with open(matrix_path, 'w') as file:
+        for principal in principals:
+            if statuses.get(principal, {}).get('') == 'Admin':
+                file.write(',{} (Admin)'.format(principal))
+            else:
+                file.write(',{}'.format(principal))
         file.write('\n')
-    file.close()
-    print('Privilege escalation check completed. Results stored to ./all_user_privesc_scan_results_{}.csv'.format(now))
+        for method in methods:
+            file.write('{},'.format(method))
+            for principal in principals:
+                file.write('{},'.format(statuses.get(principal, {}).get(method, '')))
+            file.write('\n')
+
+# State kept between --state-file runs: the attached managed policies seen last time (version, update date and document)
+# and each user's fingerprint and results
+def load_state(path):
+    if not os.path.exists(path):
+        return {'Policies': {}, 'Users': {}}
+    with open(path) as f:
+        return json.load(f)
+
+def save_state(state, path):
+    state['Time'] = time.time()
+    with open(path, 'w') as f:
+        json.dump(state, f, default=str)
+
+# What a checkpoint's results depend on besides the account itself, a checkpoint of another scope is not resumed
+def checkpoint_scope(args, inventory=None):
+    return json.dumps({
+        'AllUsers': args.all_users,
+        'UserName': args.user_name,
+        'Bulk': args.bulk,
+        'SaveSnapshot': args.save_snapshot is not None,
+        'Inventory': inventory.digest if inventory is not None else None
+    }, sort_keys=True)
+
+# SQLite store of a scan in progress, written in batches, so an interrupted run can be continued with --resume
+class CheckpointStore(object):
+    def __init__(self, path, scope, resume=False, batch_size=100, interval=5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.queue = []
+        self.last_commit = time.monotonic()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS listed (position INTEGER PRIMARY KEY, user_name TEXT, arn TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS users (user_name TEXT PRIMARY KEY, record TEXT)')
+        if resume is True and self.get('Scope') not in [None, scope]:
+            print('Checkpoint {} is from a scan with other options, starting over.'.format(path))
+            resume = False
+        if resume is not True:
+            for table in ['meta', 'listed', 'users']:
+                self.connection.execute('DELETE FROM {}'.format(table))
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('Scope', scope))
+        self.connection.commit()
+        self.done = dict(self.connection.execute('SELECT user_name, record FROM users'))
+        self.resumed = set()
+
+    def get(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    # The users listed so far, the marker to continue the listing from and whether it is complete
+    def listing(self):
+        listed = [{'UserName': user_name, 'Arn': arn} for user_name, arn in self.connection.execute('SELECT user_name, arn FROM listed ORDER BY position')]
+        return listed, self.get('ListUsersMarker'), self.get('ListUsersDone') == 'true'
+
+    # One page of list_users, committed right away with the marker of the next page (None on the last page)
+    def add_listed(self, page, marker):
+        with self.lock:
+            position = self.connection.execute('SELECT COUNT(*) FROM listed').fetchone()[0]
+            self.connection.executemany('INSERT INTO listed VALUES (?, ?, ?)', [(position + offset, user['UserName'], user['Arn']) for offset, user in enumerate(page)])
+            self.connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('ListUsersMarker', marker), ('ListUsersDone', 'true' if marker is None else 'false')])
+            self.connection.commit()
+
+    # Put the recorded principal in place of each user the checkpoint is done with, returning their indexes. Users whose
+    # collection failed part way (PermissionsConfirmed False) are not done, they are collected again
+    def resume_users(self, users):
+        resumed = set()
+        for index, user in enumerate(users):
+            record = self.done.get(user['UserName'])
+            if record is None:
+                continue
+            principal = json.loads(record)
+            if principal.get('PermissionsConfirmed') is not False:
+                users[index] = Principal.from_dict(principal)
+                self.resumed.add(user['UserName'])
+                resumed.add(index)
+        return resumed
+
+    def add(self, user):
+        if user['UserName'] in self.resumed:
+            return
+        record = json.dumps(user.to_dict() if isinstance(user, Principal) else user, default=str)
+        with self.lock:
+            self.queue.append((user['UserName'], record))
+            due = len(self.queue) >= self.batch_size or time.monotonic() - self.last_commit >= self.interval
+        if due:
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.queue != []:
+                self.connection.executemany('INSERT OR REPLACE INTO users VALUES (?, ?)', self.queue)
+                self.connection.commit()
+            self.queue = []
+            self.last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+# Learn the current default version of every attached managed policy from a few ListPolicies pages, so get_policy is never
+# needed, and put the previous run's documents back in the cache for policies whose version and update date did not change
+def seed_cache_from_state(client, cache, state):
+    reused = 0
+    paginator = client.get_paginator('list_policies')
+    for page in paginator.paginate(OnlyAttached=True):
+        for policy in page['Policies']:
+            policy_arn = policy['Arn']
+            update_date = str(policy.get('UpdateDate'))
+            cache.default_versions[policy_arn] = policy['DefaultVersionId']
+            cache.update_dates[policy_arn] = update_date
+            previous = state['Policies'].get(policy_arn)
+            if previous is not None and previous['DefaultVersionId'] == policy['DefaultVersionId'] and previous.get('UpdateDate') == update_date:
+                cache.documents[(policy_arn, policy['DefaultVersionId'])] = previous['Document']
+                reused += 1
+    return reused
+
+# Hash of everything a user's results depend on: its own policies, its groups' policies and the versions of every attached
+# managed policy. None when collection was incomplete, so the user is always rescanned
+def user_fingerprint(user, cache):
+    if user.get('PermissionsConfirmed') is False or 'Details' not in user:
+        return None
+    groups = [cache.groups[name].get('Details') for name in sorted(user['Details']['GroupList']) if name in cache.groups]
+    attached = [policy['PolicyArn'] for policy in user['Details']['AttachedManagedPolicies']]
+    for group in groups:
+        attached += [policy['PolicyArn'] for policy in (group or {}).get('AttachedManagedPolicies', [])]
+    versions = sorted((policy_arn, cache.default_versions.get(policy_arn)) for policy_arn in set(attached))
+    data = json.dumps([user['Details'], groups, versions], sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+# Fingerprints of the users in an authorization details feed, from their own records, their groups' and the versions of the
+# managed policies attached to either
+def detail_fingerprints(details):
+    groups = dict((group['GroupName'], group) for group in details.get('GroupDetailList', []))
+    versions = dict((policy['Arn'], [policy.get('DefaultVersionId'), str(policy.get('UpdateDate'))]) for policy in details.get('Policies', []))
+    fingerprints = {}
+    for detail in details.get('UserDetailList', []):
+        user_groups = [groups.get(name) for name in sorted(detail.get('GroupList', []))]
+        attached = [policy['PolicyArn'] for policy in detail.get('AttachedManagedPolicies', [])]
+        for group in user_groups:
+            attached += [policy['PolicyArn'] for policy in (group or {}).get('AttachedManagedPolicies', [])]
+        data = json.dumps([detail, user_groups, sorted((policy_arn, versions.get(policy_arn)) for policy_arn in set(attached))], sort_keys=True, default=str)
+        fingerprints[detail['UserName']] = hashlib.sha1(data.encode('utf-8')).hexdigest()
+    return fingerprints
+
+# Compare the previous run's results with this one's: new and removed users, and for every other user the methods whose
+# status changed between none, Potential, Confirmed and Admin
+def diff_results(previous, users):
+    def statuses(checked_methods):
+        if 'admin' in checked_methods:
+            return {'Admin': 'Admin'}
+        result = dict((method, 'Potential') for method in checked_methods['Potential'])
+        result.update((method, 'Confirmed') for method in checked_methods['Confirmed'])
+        return result
+
+    current = dict((user['UserName'], user) for user in users)
+    diff = {
+        'AddedUsers': sorted(name for name in current if name not in previous),
+        'RemovedUsers': sorted(name for name in previous if name not in current),
+        'Changed': {}
+    }
+    for name, user in current.items():
+        if name not in previous:
+            continue
+        before = statuses(previous[name]['CheckedMethods'])
+        after = statuses(user['CheckedMethods'])
+        changes = dict((method, (before.get(method), after.get(method))) for method in set(before) | set(after) if before.get(method) != after.get(method))
+        if changes != {}:
+            diff['Changed'][name] = changes
+    return diff
 
 # https://stackoverflow.com/a/24893252
 def remove_empty_from_dict(d):
@@ -376,17 +2548,26 @@ def remove_empty_from_dict(d):
         return d
 
 # Pull permissions from each policy document
-def parse_attached_policies(client, attached_policies, user):
-    for policy in attached_policies:
-        document = get_attached_policy(client, policy['PolicyArn'])
+def parse_attached_policies(client, attached_policies, user, cache=None):
+    for index, policy in enumerate(attached_policies):
+        if cache is not None and cache.settled(user):
+            cache.skip(sum(cache.policy_calls(policy['PolicyArn']) for policy in attached_policies[index:]))
+            break
+        document = get_attached_policy(client, policy['PolicyArn'], cache)
         if document is False:
             user['PermissionsConfirmed'] = False
         else:
             user = parse_document(document, user)
     return user
 
-# Get the policy document of an attached policy
-def get_attached_policy(client, policy_arn):
+# Get the policy document of an attached policy, through the cache when one is passed in
+def get_attached_policy(client, policy_arn, cache=None):
+    if cache is not None:
+        version = cache.get_default_version(client, policy_arn)
+        if version is False:
+            return False
+        return cache.get_document(client, policy_arn, version)
+
     try:
         policy = client.get_policy(
             PolicyArn=policy_arn
@@ -408,119 +2589,158 @@ def get_attached_policy(client, policy_arn):
         print('Get policy version failed: {}'.format(e))
         return False
 
+# Flatten a policy document into (effect, actions, resources) tuples without modifying it. Single values are wrapped in lists,
+# and a NotAction is reversed: allowing a NotAction is basically denying those actions and denying a NotAction allows them
+def normalize_statements(document):
+    statements = document['Statement']
+    if type(statements) is dict:
+        statements = [statements]
+    for statement in statements:
+        resources = statement.get('Resource', [])
+        if type(resources) is not list:
+            resources = [resources]
+        resources = [intern(resource) for resource in resources]
+        effect = statement['Effect']
+        if 'Action' in statement:
+            actions = statement['Action']
+            yield effect, actions if type(actions) is list else [actions], resources
+        if 'NotAction' in statement:
+            actions = statement['NotAction']
+            yield 'Deny' if effect == 'Allow' else 'Allow', actions if type(actions) is list else [actions], resources
+
+# Add resources to one action of an Allow or Deny map. While a principal is being collected its resources are sets, so
+# duplicates are dropped on insert instead of rebuilding the whole list each time
+def add_resources(permissions, action, resources):
+    existing = permissions.get(action)
+    if existing is None:
+        permissions[intern(action)] = set(resources)
+    elif type(existing) is set:
+        existing.update(resources)
+    else: # Finalized maps come from the pool and are shared with other principals
+        raise ValueError('Cannot add resources to the finalized permissions of a principal')
+
 # Loop permissions and the resources they apply to
 def parse_document(document, user):
-    if type(document['Statement']) is dict:
-        document['Statement'] = [document['Statement']]
-    for statement in document['Statement']:
-        if statement['Effect'] == 'Allow':
-            if 'Action' in statement and type(statement['Action']) is list: # Check if the action is a single action (str) or multiple (list)
-                statement['Action'] = list(set(statement['Action'])) # Remove duplicates to stop the circular reference JSON error
-                for action in statement['Action']:
-                    if action in user['Permissions']['Allow']:
-                        if type(statement['Resource']) is list:
-                            user['Permissions']['Allow'][action] += statement['Resource']
-                        else:
-                            user['Permissions']['Allow'][action].append(statement['Resource'])
-                    else:
-                        if type(statement['Resource']) is list:
-                            user['Permissions']['Allow'][action] = statement['Resource']
-                        else:
-                            user['Permissions']['Allow'][action] = [statement['Resource']]
-                    user['Permissions']['Allow'][action] = list(set(user['Permissions']['Allow'][action])) # Remove duplicate resources
-            elif 'Action' in statement and type(statement['Action']) is str:
-                if statement['Action'] in user['Permissions']['Allow']:
-                    if type(statement['Resource']) is list:
-                        user['Permissions']['Allow'][statement['Action']] += statement['Resource']
-                    else:
-                        user['Permissions']['Allow'][statement['Action']].append(statement['Resource'])
-                else:
-                    if type(statement['Resource']) is list:
-                        user['Permissions']['Allow'][statement['Action']] = statement['Resource']
-                    else:
-                        user['Permissions']['Allow'][statement['Action']] = [statement['Resource']] # Make sure that resources are always arrays
-                user['Permissions']['Allow'][statement['Action']] = list(set(user['Permissions']['Allow'][statement['Action']])) # Remove duplicate resources
-            if 'NotAction' in statement and type(statement['NotAction']) is list: # NotAction is reverse, so allowing a NotAction is denying that action basically
-                statement['NotAction'] = list(set(statement['NotAction'])) # Remove duplicates to stop the circular reference JSON error
-                for not_action in statement['NotAction']:
-                    if not_action in user['Permissions']['Deny']:
-                        if type(statement['Resource']) is list:
-                            user['Permissions']['Deny'][not_action] += statement['Resource']
-                        else:
-                            user['Permissions']['Deny'][not_action].append(statement['Resource'])
-                    else:
-                        if type(statement['Resource']) is list:
-                            user['Permissions']['Deny'][not_action] = statement['Resource']
-                        else:
-                            user['Permissions']['Deny'][not_action] = [statement['Resource']]
-                    user['Permissions']['Deny'][not_action] = list(set(user['Permissions']['Deny'][not_action])) # Remove duplicate resources
-            elif 'NotAction' in statement and type(statement['NotAction']) is str:
-                if statement['NotAction'] in user['Permissions']['Deny']:
-                    if type(statement['Resource']) is list:
-                        user['Permissions']['Deny'][statement['NotAction']] += statement['Resource']
-                    else:
-                        user['Permissions']['Deny'][statement['NotAction']].append(statement['Resource'])
-                else:
-                    if type(statement['Resource']) is list:
-                        user['Permissions']['Deny'][statement['NotAction']] = statement['Resource']
-                    else:
-                        user['Permissions']['Deny'][statement['NotAction']] = [statement['Resource']] # Make sure that resources are always arrays
-                user['Permissions']['Deny'][statement['NotAction']] = list(set(user['Permissions']['Deny'][statement['NotAction']])) # Remove duplicate resources
-        if statement['Effect'] == 'Deny':
-            if 'Action' in statement and type(statement['Action']) is list:
-                statement['Action'] = list(set(statement['Action'])) # Remove duplicates to stop the circular reference JSON error
-                for action in statement['Action']:
-                    if action in user['Permissions']['Deny']:
-                        if type(statement['Resource']) is list:
-                            user['Permissions']['Deny'][action] += statement['Resource']
-                        else:
-                            user['Permissions']['Deny'][action].append(statement['Resource'])
-                    else:
-                        if type(statement['Resource']) is list:
-                            user['Permissions']['Deny'][action] = statement['Resource']
-                        else:
-                            user['Permissions']['Deny'][action] = [statement['Resource']]
-                    user['Permissions']['Deny'][action] = list(set(user['Permissions']['Deny'][action])) # Remove duplicate resources
-            elif 'Action' in statement and type(statement['Action']) is str:
-                if statement['Action'] in user['Permissions']['Deny']:
-                    if type(statement['Resource']) is list:
-                        user['Permissions']['Deny'][statement['Action']] += statement['Resource']
-                    else:
-                        user['Permissions']['Deny'][statement['Action']].append(statement['Resource'])
-                else:
-                    if type(statement['Resource']) is list:
-                        user['Permissions']['Deny'][statement['Action']] = statement['Resource']
-                    else:
-                        user['Permissions']['Deny'][statement['Action']] = [statement['Resource']] # Make sure that resources are always arrays
-                user['Permissions']['Deny'][statement['Action']] = list(set(user['Permissions']['Deny'][statement['Action']])) # Remove duplicate resources
-            if 'NotAction' in statement and type(statement['NotAction']) is list: # NotAction is reverse, so allowing a NotAction is denying that action basically
-                statement['NotAction'] = list(set(statement['NotAction'])) # Remove duplicates to stop the circular reference JSON error
-                for not_action in statement['NotAction']:
-                    if not_action in user['Permissions']['Allow']:
-                        if type(statement['Resource']) is list:
-                            user['Permissions']['Allow'][not_action] += statement['Resource']
-                        else:
-                            user['Permissions']['Allow'][not_action].append(statement['Resource'])
-                    else:
-                        if type(statement['Resource']) is list:
-                            user['Permissions']['Allow'][not_action] = statement['Resource']
-                        else:
-                            user['Permissions']['Allow'][not_action] = [statement['Resource']]
-                    user['Permissions']['Allow'][not_action] = list(set(user['Permissions']['Allow'][not_action])) # Remove duplicate resources
-            elif 'NotAction' in statement and type(statement['NotAction']) is str:
-                if statement['NotAction'] in user['Permissions']['Allow']:
-                    if type(statement['Resource']) is list:
-                        user['Permissions']['Allow'][statement['NotAction']] += statement['Resource']
-                    else:
-                        user['Permissions']['Allow'][statement['NotAction']].append(statement['Resource'])
-                else:
-                    if type(statement['Resource']) is list:
-                        user['Permissions']['Allow'][statement['NotAction']] = statement['Resource']
-                    else:
-                        user['Permissions']['Allow'][statement['NotAction']] = [statement['Resource']] # Make sure that resources are always arrays
-                user['Permissions']['Allow'][statement['NotAction']] = list(set(user['Permissions']['Allow'][statement['NotAction']])) # Remove duplicate resources
+    with metrics.phase('parse'):
+        for effect, actions, resources in normalize_statements(document):
+            permissions = user['Permissions'][effect]
+            for action in actions:
+                add_resources(permissions, action, resources)
     return user
 
+# Canonical resource frozensets and Allow/Deny maps shared between principals. Pooled maps must never be modified
+class PermissionPool(object):
+    def __init__(self):
+        self.resource_sets = {}
+        self.maps = {} # hash -> [{'Allow': ..., 'Deny': ...}]
+
+    def resources(self, values):
+        values = frozenset(values)
+        return self.resource_sets.setdefault(values, values)
+
+    # Action keys are already interned by add_resources
+    def permissions(self, allow, deny):
+        allow = dict((action, self.resources(resources)) for action, resources in allow.items())
+        deny = dict((action, self.resources(resources)) for action, resources in deny.items())
+        candidates = self.maps.setdefault(hash((frozenset(allow.items()), frozenset(deny.items()))), [])
+        for permissions in candidates:
+            if permissions['Allow'] == allow and permissions['Deny'] == deny:
+                return permissions
+        permissions = {'Allow': allow, 'Deny': deny}
+        candidates.append(permissions)
+        return permissions
+
+# Shared by every principal finalized in the process
+permission_pool = PermissionPool()
+
+# A finalized user, group or role in __slots__, with the part of the dict protocol the scan uses
+class Principal(object):
+    __slots__ = ('kind', 'name', 'arn', 'permissions', 'confirmed', 'checked_methods', 'fingerprint', 'extra')
+    name_keys = {'user': 'UserName', 'group': 'GroupName', 'role': 'RoleName'}
+    fields = {'Arn': 'arn', 'Permissions': 'permissions', 'PermissionsConfirmed': 'confirmed', 'CheckedMethods': 'checked_methods', 'Fingerprint': 'fingerprint'}
+
+    def __init__(self, kind, name, permissions):
+        self.kind = kind
+        self.name = intern(name) if name is not None else None
+        self.arn = None
+        self.permissions = permissions
+        self.confirmed = None
+        self.checked_methods = None
+        self.fingerprint = None
+        self.extra = None
+
+    # A principal dict with its resources still in sets, as parse_document builds it
+    @classmethod
+    def from_dict(cls, principal, pool=None):
+        pool = pool or permission_pool
+        kind = None
+        for candidate, key in cls.name_keys.items():
+            if key in principal:
+                kind = candidate
+        compact = cls(kind, principal.get(cls.name_keys.get(kind)), pool.permissions(principal['Permissions']['Allow'], principal['Permissions']['Deny']))
+        for key, value in principal.items():
+            if key != 'Permissions' and key != cls.name_keys.get(kind):
+                compact[key] = value
+        return compact
+
+    def slot(self, key):
+        if key == self.name_keys.get(self.kind):
+            return 'name'
+        return self.fields.get(key)
+
+    def __getitem__(self, key):
+        slot = self.slot(key)
+        value = getattr(self, slot) if slot is not None else (self.extra or {}).get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        slot = self.slot(key)
+        if slot in ['name', 'arn'] and value is not None:
+            value = intern(value)
+        if slot is not None:
+            setattr(self, slot, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        slot = self.slot(key)
+        if slot is not None:
+            return getattr(self, slot) is not None
+        return key in (self.extra or {})
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        if key in self:
+            self[key] = None
+            if self.slot(key) is None:
+                del self.extra[key]
+        return value
+
+    def keys(self):
+        keys = [key for key in [self.name_keys.get(self.kind)] + list(self.fields) if key is not None and key in self]
+        return keys + list(self.extra or {})
+
+    def to_dict(self):
+        principal = dict((key, self[key]) for key in self.keys())
+        principal['Permissions'] = dict((effect, dict((action, list(resources)) for action, resources in self.permissions[effect].items())) for effect in ['Allow', 'Deny'])
+        return principal
+
+    def __repr__(self):
+        return 'Principal({!r}, {!r})'.format(self.kind, self.name)
+
+# Turn a principal collected into sets by parse_document into its compact, immutable form, once per principal
+def finalize_permissions(principal):
+    if isinstance(principal, Principal):
+        return principal
+    return Principal.from_dict(principal)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='This script will fetch permissions for a set of users and then scan for permission misconfigurations to see what privilege escalation methods are possible. Available attack paths will be output to a .csv file in the same directory.')
     parser.add_argument('--all-users', required=False, default=False, action='store_true', help='Run this module against every user in the account.')
@@ -528,6 +2748,30 @@ if __name__ == '__main__':
     parser.add_argument('--access-key-id', required=False, default=None, help='The AWS access key ID to use for authentication.')
     parser.add_argument('--secret-key', required=False, default=None, help='The AWS secret access key to use for authentication.')
     parser.add_argument('--session-token', required=False, default=None, help='The AWS session token to use for authentication, if there is one.')
+    parser.add_argument('--bulk', required=False, default=False, action='store_true', help='Collect the whole account with GetAccountAuthorizationDetails (a few paginated calls in total) instead of listing policies user by user.')
+    parser.add_argument('--lazy', required=False, default=False, action='store_true', help='Stop fetching the policies of a user or group as soon as the ones fetched so far settle its results, e.g. once it is known to be an admin. The results are the same, with fewer API calls. Not used with --bulk or --save-snapshot.')
+    parser.add_argument('--from-snapshot', required=False, default=None, help='Analyze saved IAM data offline instead of calling the API: an authorization details dump, a ListRoles dump, a policy document, or a directory of them. No credentials are needed.')
+    parser.add_argument('--parse-workers', required=False, default=0, type=int, help='Read a --from-snapshot authorization details file one record at a time instead of loading it whole, and parse and evaluate the users in this many worker processes. Memory use no longer grows with the size of the file. Other snapshot formats are loaded whole. --paths and --trust are not available this way. Defaults to 0 (load the whole file).')
+    parser.add_argument('--save-snapshot', required=False, default=None, help='Write the collected users, groups and policies to this path in GetAccountAuthorizationDetails format, for later use with --from-snapshot.')
+    parser.add_argument('--output-format', required=False, default='jsonl', choices=['jsonl', 'csv'], help='Format of the streamed results file, one record per user, method and status. Defaults to jsonl.')
+    parser.add_argument('--no-matrix', required=False, dest='matrix', default=True, action='store_false', help='Do not convert the results into the legacy one-column-per-user CSV at the end of the run.')
+    parser.add_argument('--to-matrix', required=False, default=None, help='Convert the streamed results file of an earlier run into the legacy one-column-per-user CSV and exit.')
+    parser.add_argument('--state-file', required=False, default=None, help='Keep state between runs in this file. Managed policies whose version did not change are not fetched again, users whose policies did not change keep the previous results, and a diff against the previous run is written. Without --bulk every user is still collected again, only their evaluation is reused; with --bulk the whole account takes a few calls.')
+    parser.add_argument('--paths', required=False, default=False, action='store_true', help='Also search for multi-hop paths to admin through other users and roles (sts:AssumeRole, credential creation and role passing).')
+    parser.add_argument('--max-depth', required=False, default=5, type=int, help='Longest escalation path to search for with --paths. Defaults to 5.')
+    parser.add_argument('--trust', required=False, default=False, action='store_true', help='Also index the trust policies of the roles (from --bulk, --from-snapshot or --roles-file), flag trusts open to any AWS principal or to any identity of a federated provider such as GitHub Actions OIDC, list the roles each user can assume with sts:AssumeRole, and the roles each federated subject named in a trust policy can assume.')
+    parser.add_argument('--checkpoint-file', required=False, default=None, help='Record the scan in this SQLite file as it goes: each page of the user listing and each user once its results are written. An interrupted run can then be continued with --resume.')
+    parser.add_argument('--resume', required=False, default=False, action='store_true', help='Continue the scan recorded in --checkpoint-file (all_user_privesc_checkpoint.sqlite by default): users it holds results for are not collected again and the user listing continues from the last recorded marker. The results file still covers every user.')
+    parser.add_argument('--checkpoint-batch', required=False, default=100, type=int, help='Number of users written to the checkpoint in one transaction. Pending users are also written every 5 seconds and when the run stops. Defaults to 100.')
+    parser.add_argument('--roles-file', required=False, default=None, help='Roles to include in the --paths and --trust analysis, from a ListRoles dump such as all-roles.json or any --from-snapshot input. Roles are collected automatically with --bulk and --from-snapshot.')
+    parser.add_argument('--inventory', required=False, default=None, help='Resources that exist in the account, to rate scoped findings against: an authorization details dump (e.g. from --save-snapshot), ListRoles, ListUsers, ListGroups or ListPolicies dumps such as all-roles.json, or a directory of them. A finding whose permission only applies to resources that do not exist is dropped, and a potential one that applies to existing resources is confirmed.')
+    parser.add_argument('--serve', required=False, default=None, type=int, help='Instead of writing results, load the principals once (from --from-snapshot, or the API as selected by the other options) and answer queries on this port of 127.0.0.1: GET /who-can?action=iam:PassRole&action=lambda:CreateFunction, /methods?principal=NAME, /who-has?method=NAME, /stats, and POST /refresh?principal=NAME to collect one principal again.')
+    parser.add_argument('--accounts', required=False, default=None, help='File with one AWS profile name or role ARN to assume per line. Every account is scanned in full, in parallel, and the results are merged into one file keyed by account ID.')
+    parser.add_argument('--account-workers', required=False, default=4, type=int, help='Number of accounts to scan in parallel processes with --accounts. --workers caps the collection threads within each account. Defaults to 4.')
+    parser.add_argument('--prometheus-file', required=False, default=None, help='Also write the IAM call and phase timing metrics of the run to this file in the Prometheus text format, e.g. for the node_exporter textfile collector. A JSON summary is always written.')
+    parser.add_argument('--target-rps', required=False, default=20, type=float, help='Most IAM requests per second to send, shared by all worker threads. The rate is lowered automatically while IAM throttles and raised back up to this target afterwards. 0 disables the limit (throttled calls are still retried). Defaults to 20.')
+    parser.add_argument('--max-throttle-retries', required=False, default=10, type=int, help='How many times a throttled IAM call is retried, with jittered exponential backoff, before the user is marked as unconfirmed. Defaults to 10.')
+    parser.add_argument('--workers', required=False, default=1, type=int, help='Number of users to collect policies for in parallel, each worker thread using its own IAM client. Defaults to 1 (sequential).')
 
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# Benchmarks for aws_escalate.py, run without AWS credentials: micro-benchmarks of the hot paths, and end to end runs
+# against synthetic accounts served by a fake IAM client
+from __future__ import print_function
+import argparse, copy, json, os, random, re, threading, time, tracemalloc
+from contextlib import redirect_stdout
+import aws_escalate
+
+services = ['iam', 'ec2', 's3', 'lambda', 'dynamodb', 'glue', 'sts', 'cloudformation', 'datapipeline', 'kms', 'sqs', 'sns', 'rds', 'logs', 'cloudwatch']
+verbs = ['Get', 'List', 'Describe', 'Put', 'Create', 'Update', 'Delete', 'Attach', 'Detach', 'Pass', 'Set', 'Invoke', 'Run']
+
+# A principal whose Allow map has the given number of wildcard actions and about as many exact ones
+def synthetic_permissions(rnd, wildcards):
+    permissions = {}
+    for _ in range(wildcards):
+        permissions['{}:{}*'.format(rnd.choice(services), rnd.choice(verbs))] = ['*']
+        permissions['{}:{}{}'.format(rnd.choice(services), rnd.choice(verbs), rnd.choice(['Role', 'User', 'Item', 'Function', 'Bucket']))] = ['arn:aws:iam::111111111111:role/x']
+    return permissions
+
+# The scan loop as it was before ActionMatcher: a fresh re.compile and unanchored search per permission and wildcard
+def legacy_check(permissions, all_perms):
+    checked_perms = {}
+    for perm in all_perms:
+        if perm in permissions:
+            checked_perms[perm] = permissions[perm]
+        else:
+            for user_perm in permissions.keys():
+                if '*' in user_perm:
+                    pattern = re.compile(user_perm.replace('*', '.*'))
+                    if pattern.search(perm) is not None:
+                        checked_perms[perm] = permissions[user_perm]
+    return checked_perms
+
+def matcher_check(permissions, all_perms):
+    return aws_escalate.ActionMatcher(permissions).match_all(all_perms)
+
+def timed(function, principals):
+    start = time.perf_counter()
+    for permissions in principals:
+        function(permissions, aws_escalate.all_perms)
+    return time.perf_counter() - start
+
+# The per-user method walk as it was before MethodTable
+def legacy_methods(checked_perms, escalation_methods):
+    checked_methods = {'Potential': [], 'Confirmed': []}
+    for method in escalation_methods:
+        potential = True
+        confirmed = True
+        for perm in escalation_methods[method]:
+            if perm not in checked_perms['Allow']:
+                potential = confirmed = False
+                break
+            elif perm in checked_perms['Deny'] and perm in checked_perms['Allow']:
+                confirmed = False
+            elif perm in checked_perms['Allow'] and perm not in checked_perms['Deny']:
+                if not checked_perms['Allow'][perm] == ['*']:
+                    confirmed = False
+        if confirmed is True:
+            checked_methods['Confirmed'].append(method)
+        elif potential is True:
+            checked_methods['Potential'].append(method)
+    return checked_methods
+
+# Random check_permissions() results: each target permission Allowed (on '*' or scoped) and/or Denied
+def synthetic_checked_perms(rnd):
+    checked_perms = {'Allow': {}, 'Deny': {}}
+    for perm in aws_escalate.all_perms:
+        if rnd.random() < 0.5:
+            checked_perms['Allow'][perm] = ['*'] if rnd.random() < 0.5 else ['arn:aws:iam::111111111111:role/x']
+        if rnd.random() < 0.05:
+            checked_perms['Deny'][perm] = ['*']
+    return checked_perms
+
+def bench_methods(args):
+    rnd = random.Random(args.seed)
+    checked = [synthetic_checked_perms(rnd) for _ in range(args.principals)]
+    table = aws_escalate.MethodTable(aws_escalate.escalation_methods, aws_escalate.all_perms)
+    print('Escalation method evaluation for {} principals ({})'.format(args.principals, 'numpy' if aws_escalate.numpy is not None else 'python ints'))
+    start = time.perf_counter()
+    legacy = [legacy_methods(checked_perms, aws_escalate.escalation_methods) for checked_perms in checked]
+    print('  legacy loop:  {:.4f}s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    encoded = [table.encode(checked_perms) for checked_perms in checked]
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    results = table.evaluate(encoded)
+    print('  method table: {:.4f}s ({:.4f}s encoding, {:.4f}s evaluation)'.format(encode_time + time.perf_counter() - start, encode_time, time.perf_counter() - start))
+    print('  identical results: {}'.format(legacy == results))
+
+def bench_matcher(args):
+    rnd = random.Random(args.seed)
+    print('Action matching for {} principals against {} target actions'.format(args.principals, len(aws_escalate.all_perms)))
+    print('{:>10} {:>12} {:>12} {:>8}'.format('wildcards', 'legacy (s)', 'matcher (s)', 'speedup'))
+    for wildcards in [1, 10, 50, 200]:
+        principals = [synthetic_permissions(rnd, wildcards) for _ in range(args.principals)]
+        legacy = timed(legacy_check, principals)
+        matcher = timed(matcher_check, principals)
+        print('{:>10} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(wildcards, legacy, matcher, legacy / matcher))
+
+# parse_document as it was before the single-pass parser, kept verbatim for comparison
+def legacy_parse_document(document, user):
+    if type(document['Statement']) is dict:
+        document['Statement'] = [document['Statement']]
+    for statement in document['Statement']:
+        if statement['Effect'] == 'Allow':
+            if 'Action' in statement and type(statement['Action']) is list: # Check if the action is a single action (str) or multiple (list)
+                statement['Action'] = list(set(statement['Action'])) # Remove duplicates to stop the circular reference JSON error
+                for action in statement['Action']:
+                    if action in user['Permissions']['Allow']:
+                        if type(statement['Resource']) is list:
+                            user['Permissions']['Allow'][action] += statement['Resource']
+                        else:
+                            user['Permissions']['Allow'][action].append(statement['Resource'])
+                    else:
+                        if type(statement['Resource']) is list:
+                            user['Permissions']['Allow'][action] = statement['Resource']
+                        else:
+                            user['Permissions']['Allow'][action] = [statement['Resource']]
+                    user['Permissions']['Allow'][action] = list(set(user['Permissions']['Allow'][action])) # Remove duplicate resources
+            elif 'Action' in statement and type(statement['Action']) is str:
+                if statement['Action'] in user['Permissions']['Allow']:
+                    if type(statement['Resource']) is list:
+                        user['Permissions']['Allow'][statement['Action']] += statement['Resource']
+                    else:
+                        user['Permissions']['Allow'][statement['Action']].append(statement['Resource'])
+                else:
+                    if type(statement['Resource']) is list:
+                        user['Permissions']['Allow'][statement['Action']] = statement['Resource']
+                    else:
+                        user['Permissions']['Allow'][statement['Action']] = [statement['Resource']] # Make sure that resources are always arrays
+                user['Permissions']['Allow'][statement['Action']] = list(set(user['Permissions']['Allow'][statement['Action']])) # Remove duplicate resources
+            if 'NotAction' in statement and type(statement['NotAction']) is list: # NotAction is reverse, so allowing a NotAction is denying that action basically
+                statement['NotAction'] = list(set(statement['NotAction'])) # Remove duplicates to stop the circular reference JSON error
+                for not_action in statement['NotAction']:
+                    if not_action in user['Permissions']['Deny']:
+                        if type(statement['Resource']) is list:
+                            user['Permissions']['Deny'][not_action] += statement['Resource']
+                        else:
+                            user['Permissions']['Deny'][not_action].append(statement['Resource'])
+                    else:
+                        if type(statement['Resource']) is list:
+                            user['Permissions']['Deny'][not_action] = statement['Resource']
+                        else:
+                            user['Permissions']['Deny'][not_action] = [statement['Resource']]
+                    user['Permissions']['Deny'][not_action] = list(set(user['Permissions']['Deny'][not_action])) # Remove duplicate resources
+            elif 'NotAction' in statement and type(statement['NotAction']) is str:
+                if statement['NotAction'] in user['Permissions']['Deny']:
+                    if type(statement['Resource']) is list:
+                        user['Permissions']['Deny'][statement['NotAction']] += statement['Resource']
+                    else:
+                        user['Permissions']['Deny'][statement['NotAction']].append(statement['Resource'])
+                else:
+                    if type(statement['Resource']) is list:
+                        user['Permissions']['Deny'][statement['NotAction']] = statement['Resource']
+                    else:
+                        user['Permissions']['Deny'][statement['NotAction']] = [statement['Resource']] # Make sure that resources are always arrays
+                user['Permissions']['Deny'][statement['NotAction']] = list(set(user['Permissions']['Deny'][statement['NotAction']])) # Remove duplicate resources
+        if statement['Effect'] == 'Deny':
+            if 'Action' in statement and type(statement['Action']) is list:
+                statement['Action'] = list(set(statement['Action'])) # Remove duplicates to stop the circular reference JSON error
+                for action in statement['Action']:
+                    if action in user['Permissions']['Deny']:
+                        if type(statement['Resource']) is list:
+                            user['Permissions']['Deny'][action] += statement['Resource']
+                        else:
+                            user['Permissions']['Deny'][action].append(statement['Resource'])
+                    else:
+                        if type(statement['Resource']) is list:
+                            user['Permissions']['Deny'][action] = statement['Resource']
+                        else:
+                            user['Permissions']['Deny'][action] = [statement['Resource']]
+                    user['Permissions']['Deny'][action] = list(set(user['Permissions']['Deny'][action])) # Remove duplicate resources
+            elif 'Action' in statement and type(statement['Action']) is str:
+                if statement['Action'] in user['Permissions']['Deny']:
+                    if type(statement['Resource']) is list:
+                        user['Permissions']['Deny'][statement['Action']] += statement['Resource']
+                    else:
+                        user['Permissions']['Deny'][statement['Action']].append(statement['Resource'])
+                else:
+                    if type(statement['Resource']) is list:
+                        user['Permissions']['Deny'][statement['Action']] = statement['Resource']
+                    else:
+                        user['Permissions']['Deny'][statement['Action']] = [statement['Resource']] # Make sure that resources are always arrays
+                user['Permissions']['Deny'][statement['Action']] = list(set(user['Permissions']['Deny'][statement['Action']])) # Remove duplicate resources
+            if 'NotAction' in statement and type(statement['NotAction']) is list: # NotAction is reverse, so allowing a NotAction is denying that action basically
+                statement['NotAction'] = list(set(statement['NotAction'])) # Remove duplicates to stop the circular reference JSON error
+                for not_action in statement['NotAction']:
+                    if not_action in user['Permissions']['Allow']:
+                        if type(statement['Resource']) is list:
+                            user['Permissions']['Allow'][not_action] += statement['Resource']
+                        else:
+                            user['Permissions']['Allow'][not_action].append(statement['Resource'])
+                    else:
+                        if type(statement['Resource']) is list:
+                            user['Permissions']['Allow'][not_action] = statement['Resource']
+                        else:
+                            user['Permissions']['Allow'][not_action] = [statement['Resource']]
+                    user['Permissions']['Allow'][not_action] = list(set(user['Permissions']['Allow'][not_action])) # Remove duplicate resources
+            elif 'NotAction' in statement and type(statement['NotAction']) is str:
+                if statement['NotAction'] in user['Permissions']['Allow']:
+                    if type(statement['Resource']) is list:
+                        user['Permissions']['Allow'][statement['NotAction']] += statement['Resource']
+                    else:
+                        user['Permissions']['Allow'][statement['NotAction']].append(statement['Resource'])
+                else:
+                    if type(statement['Resource']) is list:
+                        user['Permissions']['Allow'][statement['NotAction']] = statement['Resource']
+                    else:
+                        user['Permissions']['Allow'][statement['NotAction']] = [statement['Resource']] # Make sure that resources are always arrays
+                user['Permissions']['Allow'][statement['NotAction']] = list(set(user['Permissions']['Allow'][statement['NotAction']])) # Remove duplicate resources
+    return user
+
+# A policy with many statements that keep touching the same actions, each with its own small resource list
+def synthetic_policy(rnd, statements):
+    actions = ['{}:{}{}'.format(rnd.choice(services), rnd.choice(verbs), rnd.choice(['Role', 'User', 'Item', 'Function', 'Bucket'])) for _ in range(100)]
+    document = {'Version': '2012-10-17', 'Statement': []}
+    for index in range(statements):
+        statement = {
+            'Effect': 'Allow' if rnd.random() < 0.9 else 'Deny',
+            'Resource': ['arn:aws:s3:::bucket-{}/*'.format(rnd.randint(0, statements)) for _ in range(rnd.randint(1, 3))]
+        }
+        statement['NotAction' if rnd.random() < 0.05 else 'Action'] = rnd.sample(actions, rnd.randint(1, 10))
+        document['Statement'].append(statement)
+    return document
+
+def bench_parse(args):
+    rnd = random.Random(args.seed)
+    print('{:>11} {:>12} {:>12} {:>8}'.format('statements', 'legacy (s)', 'parser (s)', 'speedup'))
+    for statements in [50, 500, 5000]:
+        document = synthetic_policy(rnd, statements)
+        legacy_user = {'Permissions': {'Allow': {}, 'Deny': {}}}
+        start = time.perf_counter()
+        legacy_parse_document(copy.deepcopy(document), legacy_user)
+        legacy = time.perf_counter() - start
+        user = {'Permissions': {'Allow': {}, 'Deny': {}}}
+        start = time.perf_counter()
+        user = aws_escalate.finalize_permissions(aws_escalate.parse_document(document, user))
+        parser = time.perf_counter() - start
+        for effect in ['Allow', 'Deny']:
+            for action in legacy_user['Permissions'][effect]:
+                assert set(legacy_user['Permissions'][effect][action]) == set(user['Permissions'][effect][action])
+        print('{:>11} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(statements, legacy, parser, legacy / parser))
+
+# A synthetic IAM account: managed policies, groups and users with inline and attached policies, where wildcard_density is
+# the share of actions written as wildcards. Policy documents are kept serialized so every call returns fresh objects, as
+# boto3 does
+class SyntheticAccount(object):
+    def __init__(self, users, groups=20, managed_policies=50, inline_policies=2, wildcard_density=0.2, seed=0):
+        rnd = random.Random(seed)
+        self.account_id = '111111111111'
+
+        def document():
+            statements = []
+            for _ in range(rnd.randint(1, 5)):
+                actions = []
+                for _ in range(rnd.randint(1, 8)):
+                    if rnd.random() < wildcard_density:
+                        actions.append('{}:{}*'.format(rnd.choice(services), rnd.choice(verbs)))
+                    else:
+                        actions.append(rnd.choice(aws_escalate.all_perms) if rnd.random() < 0.3 else '{}:{}{}'.format(rnd.choice(services), rnd.choice(verbs), rnd.choice(['Role', 'User', 'Item', 'Function', 'Bucket'])))
+                statements.append({
+                    'Effect': 'Allow' if rnd.random() < 0.9 else 'Deny',
+                    'Action': actions,
+                    'Resource': '*' if rnd.random() < 0.6 else 'arn:aws:iam::{}:role/role-{}'.format(self.account_id, rnd.randint(0, 100))
+                })
+            return json.dumps({'Version': '2012-10-17', 'Statement': statements})
+
+        self.policies = {}
+        for index in range(managed_policies):
+            self.policies['arn:aws:iam::{}:policy/policy-{}'.format(self.account_id, index)] = ('v{}'.format(rnd.randint(1, 5)), document())
+        policy_arns = sorted(self.policies)
+        self.groups = {}
+        for index in range(groups):
+            self.groups['group-{}'.format(index)] = {
+                'Inline': dict(('inline-{}'.format(number), document()) for number in range(rnd.randint(0, inline_policies))),
+                'Attached': rnd.sample(policy_arns, min(len(policy_arns), rnd.randint(0, 3)))
+            }
+        group_names = sorted(self.groups)
+        self.users = {}
+        for index in range(users):
+            self.users['user-{}'.format(index)] = {
+                'Groups': rnd.sample(group_names, min(len(group_names), rnd.randint(0, 3))),
+                'Inline': dict(('inline-{}'.format(number), document()) for number in range(rnd.randint(0, inline_policies))),
+                'Attached': rnd.sample(policy_arns, min(len(policy_arns), rnd.randint(0, 2)))
+            }
+
+# Stand-in for a boto3 IAM client serving a SyntheticAccount, with the same pagination (Marker / IsTruncated, 100 items per
+# page) and a thread-safe count of calls per operation
+class FakeIAMClient(object):
+    page_size = 100
+
+    def __init__(self, account, calls):
+        self.account = account
+        self.calls = calls
+
+    def count(self, operation):
+        with self.calls['lock']:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def page(self, operation, items, key, Marker=None):
+        self.count(operation)
+        start = int(Marker or 0)
+        response = {key: items[start:start + self.page_size], 'IsTruncated': start + self.page_size < len(items)}
+        if response['IsTruncated'] is True:
+            response['Marker'] = str(start + self.page_size)
+        return response
+
+    def attached(self, policy_arns):
+        return [{'PolicyArn': policy_arn, 'PolicyName': policy_arn.split('/')[-1]} for policy_arn in policy_arns]
+
+    def user_arn(self, user_name):
+        return 'arn:aws:iam::{}:user/{}'.format(self.account.account_id, user_name)
+
+    def get_user(self, **kwargs):
+        self.count('GetUser')
+        user_name = sorted(self.account.users)[0]
+        return {'User': {'UserName': user_name, 'Arn': self.user_arn(user_name)}}
+
+    def list_users(self, Marker=None):
+        return self.page('ListUsers', [{'UserName': name, 'Arn': self.user_arn(name)} for name in sorted(self.account.users)], 'Users', Marker)
+
+    def list_groups_for_user(self, UserName, Marker=None):
+        return self.page('ListGroupsForUser', [{'GroupName': name} for name in self.account.users[UserName]['Groups']], 'Groups', Marker)
+
+    def list_group_policies(self, GroupName, Marker=None):
+        return self.page('ListGroupPolicies', sorted(self.account.groups[GroupName]['Inline']), 'PolicyNames', Marker)
+
+    def get_group_policy(self, GroupName, PolicyName):
+        self.count('GetGroupPolicy')
+        return {'PolicyDocument': json.loads(self.account.groups[GroupName]['Inline'][PolicyName])}
+
+    def list_attached_group_policies(self, GroupName, Marker=None):
+        return self.page('ListAttachedGroupPolicies', self.attached(self.account.groups[GroupName]['Attached']), 'AttachedPolicies', Marker)
+
+    def list_user_policies(self, UserName, Marker=None):
+        return self.page('ListUserPolicies', sorted(self.account.users[UserName]['Inline']), 'PolicyNames', Marker)
+
+    def get_user_policy(self, UserName, PolicyName):
+        self.count('GetUserPolicy')
+        return {'PolicyDocument': json.loads(self.account.users[UserName]['Inline'][PolicyName])}
+
+    def list_attached_user_policies(self, UserName, Marker=None):
+        return self.page('ListAttachedUserPolicies', self.attached(self.account.users[UserName]['Attached']), 'AttachedPolicies', Marker)
+
+    def get_policy(self, PolicyArn):
+        self.count('GetPolicy')
+        return {'Policy': {'Arn': PolicyArn, 'DefaultVersionId': self.account.policies[PolicyArn][0]}}
+
+    def get_policy_version(self, PolicyArn, VersionId):
+        self.count('GetPolicyVersion')
+        return {'PolicyVersion': {'VersionId': VersionId, 'IsDefaultVersion': True, 'Document': json.loads(self.account.policies[PolicyArn][1])}}
+
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation)
+
+class FakePaginator(object):
+    def __init__(self, client, operation):
+        self.client = client
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        account = self.client.account
+        if self.operation == 'list_policies':
+            self.client.count('ListPolicies')
+            yield {'Policies': [{'Arn': policy_arn, 'DefaultVersionId': version, 'UpdateDate': '2024-01-01T00:00:00Z'} for policy_arn, (version, document) in sorted(account.policies.items())]}
+            return
+        # get_account_authorization_details, in pages of 1,000 users like the real API's upper MaxItems
+        user_names = sorted(account.users)
+        for start in range(0, max(len(user_names), 1), 1000):
+            self.client.count('GetAccountAuthorizationDetails')
+            page = {'UserDetailList': [], 'GroupDetailList': [], 'RoleDetailList': [], 'Policies': []}
+            for name in user_names[start:start + 1000]:
+                user = account.users[name]
+                page['UserDetailList'].append({
+                    'UserName': name,
+                    'Arn': self.client.user_arn(name),
+                    'GroupList': list(user['Groups']),
+                    'UserPolicyList': [{'PolicyName': policy, 'PolicyDocument': json.loads(document)} for policy, document in sorted(user['Inline'].items())],
+                    'AttachedManagedPolicies': self.client.attached(user['Attached'])
+                })
+            if start == 0:
+                for name, group in sorted(account.groups.items()):
+                    page['GroupDetailList'].append({
+                        'GroupName': name,
+                        'GroupPolicyList': [{'PolicyName': policy, 'PolicyDocument': json.loads(document)} for policy, document in sorted(group['Inline'].items())],
+                        'AttachedManagedPolicies': self.client.attached(group['Attached'])
+                    })
+                for policy_arn, (version, document) in sorted(account.policies.items()):
+                    page['Policies'].append({
+                        'Arn': policy_arn,
+                        'DefaultVersionId': version,
+                        'PolicyVersionList': [{'VersionId': version, 'IsDefaultVersion': True, 'Document': json.loads(document)}]
+                    })
+            yield page
+
+# Collect and scan a synthetic account end to end with one collection mode, returning wall time per phase, calls per IAM
+# operation and peak traced memory (None when trace_memory is off)
+def run_account(account, mode, workers, trace_memory=True):
+    calls = {'lock': threading.Lock()}
+    options = argparse.Namespace(all_users=True, user_name=None, bulk=mode == 'bulk', workers=workers if mode == 'workers' else 1, save_snapshot=None, lazy=False)
+    if trace_memory is True:
+        tracemalloc.start()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        users, roles = aws_escalate.collect_users(lambda: FakeIAMClient(account, calls), options)
+        collected = time.perf_counter()
+        table = aws_escalate.MethodTable(aws_escalate.escalation_methods, aws_escalate.all_perms)
+        candidates = [user for user in users if not aws_escalate.is_admin(user)]
+        table.evaluate([table.encode(aws_escalate.check_permissions(user['Permissions'], table.perms)) for user in candidates])
+        scanned = time.perf_counter()
+    peak = None
+    if trace_memory is True:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    calls.pop('lock')
+    return {'collect': collected - start, 'scan': scanned - collected, 'calls': calls, 'peak': peak}
+
+def bench_account(args):
+    for size in [int(size) for size in args.sizes.split(',')]:
+        account = SyntheticAccount(size, args.groups, args.managed_policies, args.inline_policies, args.wildcard_density, args.seed)
+        print('\n{} users, {} groups, {} managed policies, wildcard density {}'.format(size, args.groups, args.managed_policies, args.wildcard_density))
+        print('  {:<10} {:>11} {:>9} {:>10} {:>10}  {}'.format('mode', 'collect (s)', 'scan (s)', 'IAM calls', 'peak (MB)', 'calls per operation'))
+        for mode in args.modes.split(','):
+            result = run_account(account, mode, args.workers, args.memory)
+            print('  {:<10} {:>11.3f} {:>9.3f} {:>10} {:>10}  {}'.format(
+                mode,
+                result['collect'],
+                result['scan'],
+                sum(result['calls'].values()),
+                '{:.1f}'.format(result['peak'] / 1024.0 / 1024.0) if result['peak'] is not None else '-',
+                ', '.join('{}={}'.format(operation, count) for operation, count in sorted(result['calls'].items()))
+            ))
+
+# Memory held by the parsed users of a synthetic account: compact principals with pooled permissions against the same users
+# exported to the plain dict shape, with one list of resources per action per user as they used to be kept
+def bench_memory(args):
+    print('{:>8} {:>12} {:>12} {:>10} {:>10}'.format('users', 'dicts (MB)', 'compact (MB)', 'reduction', 'distinct maps'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        account = SyntheticAccount(size, args.groups, args.managed_policies, args.inline_policies, args.wildcard_density, args.seed)
+        details = aws_escalate.get_account_authorization_details(FakeIAMClient(account, {'lock': threading.Lock()}))
+        aws_escalate.permission_pool = aws_escalate.PermissionPool()
+        tracemalloc.start()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            before = tracemalloc.get_traced_memory()[0]
+            users = aws_escalate.users_from_authorization_details(details)
+            compact = tracemalloc.get_traced_memory()[0] - before
+            before = tracemalloc.get_traced_memory()[0]
+            exported = [user.to_dict() for user in users]
+            plain = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print('{:>8} {:>12.1f} {:>12.1f} {:>9.1f}x {:>10}'.format(
+            size,
+            plain / 1024.0 / 1024.0,
+            compact / 1024.0 / 1024.0,
+            float(plain) / compact,
+            sum(len(maps) for maps in aws_escalate.permission_pool.maps.values())
+        ))
+        del users, exported
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline micro-benchmarks for aws_escalate.py.')
+    parser.add_argument('benchmark', choices=['matcher', 'methods', 'parse', 'account', 'memory'], help='Which benchmark to run.')
+    parser.add_argument('--principals', required=False, default=1000, type=int, help='Number of synthetic principals to evaluate.')
+    parser.add_argument('--sizes', required=False, default='10,1000,50000', help='Comma separated numbers of users in the synthetic accounts for the account and memory benchmarks.')
+    parser.add_argument('--modes', required=False, default='sequential,workers,bulk', help='Comma separated collection modes for the account benchmark: sequential, workers and bulk.')
+    parser.add_argument('--workers', required=False, default=8, type=int, help='Collection threads for the workers mode.')
+    parser.add_argument('--no-memory', required=False, dest='memory', default=True, action='store_false', help='Do not trace peak memory in the account benchmark, tracemalloc slows the runs down several times.')
+    parser.add_argument('--groups', required=False, default=20, type=int, help='Number of groups in the synthetic accounts.')
+    parser.add_argument('--managed-policies', required=False, default=50, type=int, help='Number of customer managed policies in the synthetic accounts.')
+    parser.add_argument('--inline-policies', required=False, default=2, type=int, help='Maximum number of inline policies per user and group.')
+    parser.add_argument('--wildcard-density', required=False, default=0.2, type=float, help='Share of policy actions written as wildcards.')
+    parser.add_argument('--seed', required=False, default=0, type=int, help='Random seed for the synthetic data.')
+
+    args = parser.parse_args()
+    {'matcher': bench_matcher, 'methods': bench_methods, 'parse': bench_parse, 'account': bench_account, 'memory': bench_memory}[args.benchmark](args)